@@ -1,8 +1,13 @@
+import logging
+import os
 import sys
 from PySide6.QtWidgets import QApplication
 from src.main_window import MainWindow
 
 def main():
+    # Debug chatter is off unless explicitly requested, e.g.
+    # CAPTION_LOG_LEVEL=DEBUG for the old per-image trace output
+    logging.basicConfig(level=os.environ.get('CAPTION_LOG_LEVEL', 'WARNING'))
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
@@ -1,1366 +1,1902 @@
-import os
-import json
-from pathlib import Path  # Add this import
-from PySide6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
-                              QLabel, QFileDialog, QTextEdit, QMessageBox, QComboBox,
-                              QDialog, QLineEdit, QFormLayout, QMenuBar,
-                              QMenu, QDoubleSpinBox, QSpinBox, QCheckBox, QRadioButton)
-from PySide6.QtCore import Qt, QTimer, Signal, QThread
-from PySide6.QtGui import QPixmap
-import requests
-import base64
-from tqdm import tqdm
-import time
-from src.model_download import ModelDownloadDialog  # At the top of your file
-from src.worker_thread import WorkerThread
-
-class ModelComboBox(QComboBox):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.parent = parent
-
-    def mousePressEvent(self, event):
-        if self.count() == 1 and self.currentText() == "Add new model...":
-            print("Empty state click detected, showing download dialog...")
-            dialog = ModelDownloadDialog(self.parent)
-            dialog.setWindowTitle("Download New Model")
-            dialog.setModal(True)
-            if dialog.exec():
-                print("Model download dialog accepted")
-                self.parent.refresh_models()
-        else:
-            super().mousePressEvent(event)
-
-class CaptionFormatDialog(QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("Caption Format Settings")
-        self.setModal(True)
-        self.setMinimumWidth(300)
-        
-        layout = QFormLayout(self)
-        
-        # Create input fields
-        self.tags_format = QLineEdit()
-        self.caption_format = QLineEdit()
-        
-        # Load saved settings or use defaults
-        self.load_settings()
-        
-        # Add fields to layout
-        layout.addRow("Reference Tags Format:", self.tags_format)
-        layout.addRow("Caption Save Format:", self.caption_format)
-        
-        # Add help text
-        help_text = QLabel("Enter file extensions (e.g., .txt, .caption)")
-        help_text.setStyleSheet("color: gray;")
-        layout.addRow(help_text)
-        
-        # Add save button
-        save_button = QPushButton("Save")
-        save_button.clicked.connect(self.save_settings)
-        layout.addRow(save_button)
-    
-    def load_settings(self):
-        """Load format settings from file"""
-        try:
-            if os.path.exists('format_config.json'):
-                with open('format_config.json', 'r') as f:
-                    config = json.load(f)
-                    self.tags_format.setText(config.get('tags_format', '.txt'))
-                    self.caption_format.setText(config.get('caption_format', '.caption'))
-            else:
-                # Set defaults
-                self.tags_format.setText('.txt')
-                self.caption_format.setText('.caption')
-        except Exception as e:
-            print(f"Error loading format settings: {e}")
-            # Set defaults on error
-            self.tags_format.setText('.txt')
-            self.caption_format.setText('.caption')
-    
-    def save_settings(self):
-        """Save format settings to file"""
-        try:
-            config = {
-                'tags_format': self.tags_format.text().strip(),
-                'caption_format': self.caption_format.text().strip()
-            }
-            
-            # Validate formats
-            for fmt in config.values():
-                if not fmt.startswith('.'):
-                    QMessageBox.warning(self, "Invalid Format", 
-                                     "File formats must start with a dot (.)")
-                    return
-            
-            with open('format_config.json', 'w') as f:
-                json.dump(config, f)
-            
-            self.accept()
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to save settings: {str(e)}")
-
-class BatchProcessThread(QThread):
-    progress = Signal(int, int)
-    finished = Signal(dict)
-    error = Signal(str)
-
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.api_url = kwargs.get('api_url')
-        self.api_key = kwargs.get('api_key')
-        self.image_files = kwargs.get('image_files')
-        self.user_prompt = kwargs.get('user_prompt')
-        self.sampling_config = kwargs.get('sampling_config')
-        self.use_tags = kwargs.get('use_tags')
-        self.prefix = kwargs.get('prefix', '').strip()
-        self.tags_format = kwargs.get('tags_format', '.txt')
-        self.caption_format = kwargs.get('caption_format', '.caption')
-        self.results = {}
-
-    def run(self):
-        try:
-            import os  # Add this import
-            import time  # Make sure time is imported too
-            
-            for i, image_path in enumerate(tqdm(self.image_files, desc="Processing", ncols=70), 1):
-                print(f"\nProcessing image {i}: {image_path}")  # Debug print
-                
-                try:
-                    # Try to load tags if enabled
-                    prompt = self.user_prompt
-                    if self.use_tags:
-                        try:
-                            tags_path = os.path.splitext(image_path)[0] + self.tags_format
-                            if os.path.exists(tags_path):
-                                with open(tags_path, 'r', encoding='utf-8') as f:
-                                    tags = f.read().strip()
-                                    prompt += ' Also here are booru tags for better understanding of the picture, you can use them as reference.'
-                                    prompt += f' <tags>\n{tags}\n</tags>'
-                                print(f"Loaded tags for {image_path}")  # Debug print
-                        except Exception as e:
-                            print(f"Error loading tags for {image_path}: {str(e)}")
-
-                    headers = {
-                        'Authorization': f'Bearer {self.api_key}',
-                        'accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        'Cache-Control': 'no-cache',
-                        'X-Request-ID': f'{time.time()}_{i}_{os.path.basename(image_path)}'
-                    }
-
-                    # Print image size for debugging
-                    import os
-                    print(f"Image size: {os.path.getsize(image_path)} bytes")
-
-                    with open(image_path, 'rb') as img_file:
-                        image_data = img_file.read()
-                        image_base64 = base64.b64encode(image_data).decode('utf-8')
-                        print(f"Base64 length: {len(image_base64)}")  # Debug print
-
-                    payload = {
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": f"Processing image {i} of {len(self.image_files)}: {os.path.basename(image_path)}"
-                            },
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{image_base64}"
-                                        }
-                                    },
-                                    {
-                                        "type": "text",
-                                        "text": prompt
-                                    }
-                                ]
-                            }
-                        ],
-                        **self.sampling_config
-                    }
-
-                    request_url = self.api_url.rstrip('/') + '/v1/chat/completions'
-                    print(f"Sending request for image {i}")  # Debug print
-                    
-                    response = requests.post(request_url, headers=headers, json=payload)
-                    print(f"Response for image {i}:")  # Debug print
-                    print(f"Status: {response.status_code}")
-                    print(f"Headers: {response.headers}")
-                    print(f"Body: {response.text[:200]}...")  # Print first 200 chars
-
-                    if response.status_code == 200:
-                        result = response.json()
-                        if 'choices' in result and len(result['choices']) > 0:
-                            caption = result['choices'][0]['message']['content']
-                            
-                            if self.prefix:
-                                caption = f"{self.prefix}\n{caption}"
-                                
-                            self.results[image_path] = caption
-
-                            caption_path = os.path.splitext(image_path)[0] + self.caption_format
-                            with open(caption_path, 'w', encoding='utf-8') as f:
-                                f.write(caption)
-                            print(f"Saved caption for image {i}")  # Debug print
-
-                except Exception as e:
-                    print(f"Error processing image {i} ({image_path}): {str(e)}")
-                    continue
-
-                self.progress.emit(i, len(self.image_files))
-
-            print(f"Completed processing {len(self.results)} images")  # Debug print
-            self.finished.emit(self.results)
-        except Exception as e:
-            print(f"Thread error: {str(e)}")  # Debug print
-            self.error.emit(str(e))
-
-class APIConfigDialog(QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("API Configuration")
-        self.setModal(True)
-        
-        layout = QFormLayout(self)
-        
-        self.api_url = QLineEdit(self)
-        self.api_key = QLineEdit(self)
-        
-        # Set default API URL
-        self.api_url.setText("http://127.0.0.1:5000")
-        
-        # Load saved configuration if exists
-        if os.path.exists('config.json'):
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-                self.api_url.setText(config.get('api_url', 'http://127.0.0.1:5000'))
-                self.api_key.setText(config.get('api_key', ''))
-        
-        layout.addRow("API URL:", self.api_url)
-        layout.addRow("API Key:", self.api_key)
-        
-        save_button = QPushButton("Save")
-        save_button.clicked.connect(self.save_config)
-        layout.addRow(save_button)
-    
-    def save_config(self):
-        config = {
-            'api_url': self.api_url.text(),
-            'api_key': self.api_key.text()
-        }
-        with open('config.json', 'w') as f:
-            json.dump(config, f)
-        self.accept()
-
-class SamplingConfigDialog(QDialog):
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("Sampling Configuration")
-        self.setModal(True)
-        self.setMinimumWidth(400)
-        
-        layout = QFormLayout(self)
-        
-        # Create spin boxes for each parameter with smaller minimums and more decimals
-        self.temperature = QDoubleSpinBox()
-        self.temperature.setRange(0.0, 2.0)
-        self.temperature.setSingleStep(0.001)  # Smaller step
-        self.temperature.setDecimals(4)        # More decimal places
-        
-        self.top_p = QDoubleSpinBox()
-        self.top_p.setRange(0.0, 1.0)
-        self.top_p.setSingleStep(0.001)        # Smaller step
-        self.top_p.setDecimals(4)              # More decimal places
-        
-        self.top_k = QSpinBox()
-        self.top_k.setRange(0, 100)
-        
-        self.max_tokens = QSpinBox()
-        self.max_tokens.setRange(1, 2000)
-        
-        # Add tooltips with updated information
-        self.temperature.setToolTip("Controls randomness. Higher values make output more random, lower values make it more deterministic. Can be very small (e.g., 0.001)")
-        self.top_p.setToolTip("Controls diversity. Lower values make output more focused. Can be very small (e.g., 0.001)")
-        self.top_k.setToolTip("Limits the number of tokens to sample from. 0 means no limit.")
-        self.max_tokens.setToolTip("Maximum number of tokens to generate.")
-        
-        # Add widgets to layout
-        layout.addRow("Temperature:", self.temperature)
-        layout.addRow("Top P:", self.top_p)
-        layout.addRow("Top K:", self.top_k)
-        layout.addRow("Max Tokens:", self.max_tokens)
-        
-        # Add save button
-        save_button = QPushButton("Save")
-        save_button.clicked.connect(self.save_config)
-        layout.addRow(save_button)
-        
-        # Load values
-        self.load_config()
-
-    def load_config(self):
-        """Load current sampling configuration"""
-        # Get values from parent window's sampling_config
-        config = self.parent().sampling_config
-        self.temperature.setValue(config.get('temperature', 0.5))
-        self.top_p.setValue(config.get('top_p', 0.5))
-        self.top_k.setValue(config.get('top_k', 50))
-        self.max_tokens.setValue(config.get('max_tokens', 500))
-    
-    def save_config(self):
-        config = {
-            'temperature': self.temperature.value(),
-            'top_p': self.top_p.value(),
-            'top_k': self.top_k.value(),
-            'max_tokens': self.max_tokens.value()
-        }
-        with open('sampling_config.json', 'w') as f:
-            json.dump(config, f)
-        self.accept()
-
-class MainWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("Image Caption Generator")
-        self.setMinimumSize(800, 600)
-        
-        # Initialize class variables
-        self.current_image_path = None
-        self.selected_files = []
-        self.is_batch_mode = False  # Initialize here
-        
-        # Define caption styles
-        self.caption_styles = {
-            "JSON Format": "Describe the picture in structured json-like format.",
-            "Detailed": "Give a long and detailed description of the picture.",
-            "Brief": "Describe the picture briefly.",
-            "Custom": ""  # Empty string as we'll use custom input
-        }
-        
-        # Initialize API configuration
-        self.api_url = 'http://127.0.0.1:5000'
-        self.api_key = ''
-        self.load_config()
-        
-        # Initialize sampling config from model's config or defaults
-        self.sampling_config = self.get_default_sampling_config()
-        self.load_sampling_config()
-
-        # Initialize format settings
-        self.tags_format = '.txt'
-        self.caption_format = '.caption'
-        self.load_format_settings()        
-
-        # Create menu bar
-        self.create_menu_bar()
-        
-        # Create central widget and layout
-        central_widget = QWidget()
-        self.setCentralWidget(central_widget)
-        layout = QVBoxLayout(central_widget)
-        
-        # Create model selection layout
-        model_layout = QHBoxLayout()
-        model_layout.addStretch()
-
-        model_label = QLabel("Model:")
-        self.model_combo = ModelComboBox(self)
-        self.model_combo.setMinimumWidth(200)
-
-        # Add load button
-        self.load_model_button = QPushButton("Load")
-        self.load_model_button.clicked.connect(self.load_selected_model)
-        self.load_model_button.setToolTip("Load the selected model")
-
-        model_layout.addWidget(model_label)
-        model_layout.addWidget(self.model_combo)
-        model_layout.addWidget(self.load_model_button)
-
-        # Add model selection to layout
-        layout.addLayout(model_layout)
-        
-        # Initialize models
-        print("Initializing models...")
-        self.refresh_models()
-        
-        # Add status indicator
-        self.status_label = QLabel("Checking backend status...")
-        self.status_label.setStyleSheet("color: orange")
-        layout.addWidget(self.status_label)
-        
-        # Create UI elements
-        self.image_label = QLabel()
-        self.image_label.setAlignment(Qt.AlignCenter)
-        self.image_label.setMinimumHeight(300)
-        self.image_label.setStyleSheet("border: 2px dashed gray;")
-        
-        # Create style selection combo box
-        style_layout = QHBoxLayout()
-        style_label = QLabel("Caption Style:")
-        self.style_combo = QComboBox()
-        self.style_combo.addItems(self.caption_styles.keys())
-        style_layout.addWidget(style_label)
-        style_layout.addWidget(self.style_combo)
-
-        # Add custom prompt input
-        self.custom_prompt_input = QLineEdit()
-        self.custom_prompt_input.setPlaceholderText("Enter your custom prompt here...")
-        self.custom_prompt_input.setMinimumWidth(200)
-        self.custom_prompt_input.hide()  # Hidden by default
-        style_layout.addWidget(self.custom_prompt_input)
-
-        style_layout.addStretch()
-        
-        # Create radio buttons and select button layout with prefix
-        mode_layout = QHBoxLayout()
-        
-        # Create radio buttons
-        self.single_radio = QRadioButton("Single Image")
-        self.folder_radio = QRadioButton("Folder")
-        self.single_radio.setChecked(True)  # Default to single image mode
-        
-        # Create select button
-        self.select_button = QPushButton("Select Image")
-        
-        # Create prefix input
-        prefix_label = QLabel("Prefix:")
-        self.prefix_input = QLineEdit()
-        self.prefix_input.setPlaceholderText("Optional prefix for saved files")
-        self.prefix_input.setMaximumWidth(150)  # Limit width
-        
-        # Add to horizontal layout
-        mode_layout.addWidget(self.single_radio)
-        mode_layout.addWidget(self.folder_radio)
-        mode_layout.addWidget(self.select_button)
-        mode_layout.addWidget(prefix_label)
-        mode_layout.addWidget(self.prefix_input)
-        mode_layout.addStretch()
-        
-        # Create checkbox for tags
-        self.use_tags_checkbox = QCheckBox("Use Reference Tags")
-        self.use_tags_checkbox.setToolTip("If checked, will look for matching .txt files with reference tags")
-        
-        self.generate_button = QPushButton("Generate Caption")
-        self.generate_button.setEnabled(False)
-        
-        self.caption_text = QTextEdit()
-        self.caption_text.setReadOnly(True)
-        self.caption_text.setPlaceholderText("Generated caption will appear here...")
-        
-        # Add widgets to layout
-        layout.addWidget(self.image_label)
-        layout.addLayout(style_layout)
-        layout.addLayout(mode_layout)
-        layout.addWidget(self.use_tags_checkbox)
-        layout.addWidget(self.generate_button)
-        layout.addWidget(self.caption_text)
-        
-        # Connect signals
-        self.select_button.clicked.connect(self.handle_select)
-        self.single_radio.toggled.connect(self.update_select_button)
-        self.folder_radio.toggled.connect(self.update_select_button)
-        self.generate_button.clicked.connect(self.generate_caption)
-        self.use_tags_checkbox.stateChanged.connect(self.update_generate_button_state)
-        self.style_combo.currentIndexChanged.connect(self.update_generate_button_state)
-        self.style_combo.currentTextChanged.connect(self.handle_style_selection) 
-
-        self.custom_prompt_input.textChanged.connect(self.update_generate_button_state)
-        
-        # Initialize model combo signal
-        print("Setting up model combo signal...")  # Debug print
-
-        # Load available models
-        print("Refreshing models...")  # Debug print
-        self.refresh_models()
-        
-        # Start backend status check timer
-        self.check_timer = QTimer()
-        self.check_timer.timeout.connect(self.check_backend_status)
-        self.check_timer.start(5000)
-        
-        # Start model refresh timer
-        self.model_refresh_timer = QTimer()
-        self.model_refresh_timer.timeout.connect(self.refresh_model_status)
-        self.model_refresh_timer.start(10000)
-        
-        # Initial status check
-        self.check_backend_status()
-
-    def load_selected_model(self):
-        """Load the model selected in the dropdown"""
-        selected_model = self.model_combo.currentText()
-        
-        # Don't attempt to load if it's the "Add new model..." option or separator
-        if not selected_model or selected_model == "Add new model..." or selected_model.startswith("-"):
-            QMessageBox.warning(self, "Invalid Selection", "Please select a valid model to load.")
-            return
-        
-        # Disable UI during model loading
-        self.model_combo.setEnabled(False)
-        self.load_model_button.setEnabled(False)
-        self.generate_button.setEnabled(False)
-        self.status_label.setText("Loading model...")
-        self.status_label.setStyleSheet("color: orange")
-        
-        # Create and start worker thread with keyword arguments
-        self.worker = WorkerThread(
-            task_func=self.switch_model_task,
-            model_name=selected_model,
-            api_url=self.api_url,
-            api_key=self.api_key
-        )
-        self.worker.finished.connect(self.on_switch_complete)
-        self.worker.error.connect(self.on_switch_error)
-        self.worker.start()
-
-    def switch_model_task(self, model_name, api_url, api_key):
-        """Task function to switch models (to be run in a worker thread)"""
-        try:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'X-Admin-Key': api_key,
-                'accept': 'application/json',
-                'Content-Type': 'application/json'
-            }
-
-            # First check if a model is loaded
-            health_url = api_url.rstrip('/') + '/health'
-            health_response = requests.get(health_url, headers=headers)
-            if health_response.status_code == 200:
-                # Properly unload the current model
-                print("Unloading current model...")
-                unload_url = api_url.rstrip('/') + '/v1/model/unload'
-                unload_response = requests.post(unload_url, headers=headers)
-                print(f"Unload response: {unload_response.status_code}")
-                
-                # Wait for unload to complete
-                import time
-                time.sleep(5)
-
-            # Load new model with vision enabled
-            load_url = api_url.rstrip('/') + '/v1/model/load'
-            payload = {
-                "model_name": model_name,
-                "vision": True
-            }
-            
-            print(f"Loading model: {model_name} with vision enabled")
-            
-            # Use non-streaming request first to initiate load
-            init_response = requests.post(load_url, headers=headers, json=payload)
-            if init_response.status_code != 200:
-                raise Exception(f"Error initiating model load: {init_response.text}")
-
-            # Wait for model to be fully ready
-            max_retries = 30  # Increased retries
-            for i in range(max_retries):
-                time.sleep(2)  # Wait between checks
-                
-                try:
-                    health_response = requests.get(health_url, headers=headers)
-                    if health_response.status_code == 200:
-                        health_data = health_response.json()
-                        if health_data.get("status") == "healthy":
-                            print(f"Model verified ready after {i+1} attempts")
-                            return {"status": "success", "model": model_name}
-                except Exception as e:
-                    print(f"Health check attempt {i+1} failed: {str(e)}")
-                
-                print(f"Model not ready yet, attempt {i+1} of {max_retries}")
-            
-            raise Exception("Model failed to become ready after maximum retries")
-
-        except Exception as e:
-            print(f"Exception in switch_model_task: {str(e)}")
-            raise Exception(f"Error switching model: {str(e)}")
-
-    def handle_style_selection(self, style):
-        """Handle caption style selection changes"""
-        if style == "Custom":
-            self.custom_prompt_input.show()
-        else:
-            self.custom_prompt_input.hide()
-
-    def refresh_models(self):
-        """Get list of available models and sync with currently loaded model"""
-        self.model_combo.clear()
-        
-        backend_path = Path("backend")
-        models_path = backend_path / "models"
-        
-        # Create models directory if it doesn't exist
-        models_path.mkdir(parents=True, exist_ok=True)
-        
-        # Block signals temporarily
-        self.model_combo.blockSignals(True)
-        
-        # Get list of installed models
-        models = []
-        if models_path.exists():
-            models = [d.name for d in models_path.iterdir() if d.is_dir()]
-        
-        # Add installed models if any
-        if models:
-            self.model_combo.addItems(models)
-            self.model_combo.addItem("-" * 30)  # Separator
-        
-        # Always add "Add new model..." option
-        self.model_combo.addItem("Add new model...")
-        
-        # Get currently loaded model from server
-        try:
-            # First try health endpoint
-            health_url = self.api_url.rstrip('/') + '/health'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'accept': 'application/json'
-            }
-            
-            health_response = requests.get(health_url, headers=headers, timeout=5)
-            current_model = None
-            
-            if health_response.status_code == 200:
-                health_data = health_response.json()
-                current_model = health_data.get('model_name')
-                
-                # If health endpoint doesn't provide model info, try completion endpoint
-                if not current_model:
-                    api_url = self.api_url.rstrip('/') + '/v1/chat/completions'
-                    headers['Content-Type'] = 'application/json'
-                    
-                    payload = {
-                        "messages": [{"role": "user", "content": "test"}],
-                        "max_tokens": 1
-                    }
-                    
-                    response = requests.post(api_url, headers=headers, json=payload, timeout=5)
-                    
-                    if response.status_code == 200:
-                        current_model = response.json().get('model')
-            
-            # Set the current model in combo box if found
-            if current_model:
-                print(f"Server has model loaded: {current_model}")  # Debug print
-                index = self.model_combo.findText(current_model)
-                if index >= 0:
-                    self.model_combo.setCurrentIndex(index)
-                    print(f"Set combo box to loaded model: {current_model}")  # Debug print
-                else:
-                    print(f"Warning: Loaded model {current_model} not found in available models")
-        except Exception as e:
-            print(f"Error getting current model from server: {str(e)}")
-        
-        # Connect signal for model selection changes
-        try:
-            if hasattr(self, '_model_combo_connected'):
-                try:
-                    self.model_combo.currentTextChanged.disconnect(self.handle_model_selection)
-                except TypeError:
-                    pass
-            self.model_combo.currentTextChanged.connect(self.handle_model_selection)
-            self._model_combo_connected = True
-        except Exception as e:
-            print(f"Error handling model combo signals: {str(e)}")
-        
-        # Unblock signals
-        self.model_combo.blockSignals(False)
-
-    def handle_empty_combo_click(self, event):
-        """Handle clicks on the combo box when it's empty"""
-        if not any(d.is_dir() for d in (Path("backend") / "models").iterdir()):
-            print("Opening download dialog from empty state...")
-            dialog = ModelDownloadDialog(self)
-            dialog.setWindowTitle("Download New Model")
-            dialog.setModal(True)
-            if dialog.exec():
-                print("Model download dialog accepted")
-                # Remove the custom click handler
-                self.model_combo.mousePressEvent = self.model_combo.__class__.mousePressEvent
-                self.refresh_models()
-        # Call the original mousePressEvent
-        self.model_combo.__class__.mousePressEvent(self.model_combo, event)
-    
-    def refresh_model_status(self):
-        """Periodically check and update the current model status"""
-        try:
-            health_url = self.api_url.rstrip('/') + '/health'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'accept': 'application/json'
-            }
-            
-            response = requests.get(health_url, headers=headers, timeout=5)
-            
-            if response.status_code == 200:
-                health_data = response.json()
-                current_model = health_data.get('model_name')
-                
-                if current_model:
-                    index = self.model_combo.findText(current_model)
-                    if index >= 0 and index != self.model_combo.currentIndex():
-                        self.model_combo.blockSignals(True)
-                        self.model_combo.setCurrentIndex(index)
-                        self.model_combo.blockSignals(False)
-                        print(f"Updated current model to: {current_model}")
-        
-        except Exception as e:
-            print(f"Error refreshing model status: {str(e)}")
-
-    def handle_model_selection(self, selection):
-        """Handle model selection including download option"""
-        print(f"handle_model_selection called with: {selection}")  # Debug print
-        
-        # Ignore empty selections or initial state
-        if not selection:
-            return
-            
-        if selection == "Add new model...":
-            print("Opening download dialog...")  # Debug print
-            try:
-                dialog = ModelDownloadDialog(self)
-                dialog.setWindowTitle("Download New Model")
-                dialog.setModal(True)
-                result = dialog.exec()
-                print(f"Dialog result: {result}")  # Debug print
-                
-                if result:
-                    print("Model download dialog accepted")
-                    self.refresh_models()
-                
-                # Reset selection to previous model if one exists
-                self.model_combo.blockSignals(True)
-                if self.model_combo.count() > 1:
-                    self.model_combo.setCurrentIndex(0)
-                self.model_combo.blockSignals(False)
-                
-            except Exception as e:
-                print(f"Error in handle_model_selection: {str(e)}")
-                QMessageBox.critical(self, "Error", f"Failed to open model download dialog: {str(e)}")
-        # Remove the automatic model switching part that was here
-
-    def switch_model(self, model_name):
-        # Don't attempt to switch if model_name is empty or None
-        if not model_name or model_name == "Add new model...":
-            self.model_combo.setEnabled(True)
-            return
-
-        def switch_task(model_name, api_url, api_key):
-            try:
-                headers = {
-                    'Authorization': f'Bearer {api_key}',
-                    'X-Admin-Key': api_key,
-                    'accept': 'application/json',
-                    'Content-Type': 'application/json'
-                }
-
-                # First check if a model is loaded
-                health_url = api_url.rstrip('/') + '/health'
-                health_response = requests.get(health_url, headers=headers)
-                if health_response.status_code == 200:
-                    # Properly unload the current model
-                    print("Unloading current model...")
-                    unload_url = api_url.rstrip('/') + '/v1/model/unload'
-                    unload_response = requests.post(unload_url, headers=headers)
-                    print(f"Unload response: {unload_response.status_code}")
-                    
-                    # Wait for unload to complete
-                    import time
-                    time.sleep(5)
-
-                # Load new model with vision enabled
-                load_url = api_url.rstrip('/') + '/v1/model/load'
-                payload = {
-                    "model_name": model_name,
-                    "vision": True
-                }
-                
-                print(f"Loading model: {model_name} with vision enabled")
-                
-                # Use non-streaming request first to initiate load
-                init_response = requests.post(load_url, headers=headers, json=payload)
-                if init_response.status_code != 200:
-                    raise Exception(f"Error initiating model load: {init_response.text}")
-
-                # Wait for model to be fully ready
-                max_retries = 30  # Increased retries
-                for i in range(max_retries):
-                    time.sleep(2)  # Wait between checks
-                    
-                    try:
-                        health_response = requests.get(health_url, headers=headers)
-                        if health_response.status_code == 200:
-                            health_data = health_response.json()
-                            if health_data.get("status") == "healthy":
-                                print(f"Model verified ready after {i+1} attempts")
-                                return {"status": "success", "model": model_name}
-                    except Exception as e:
-                        print(f"Health check attempt {i+1} failed: {str(e)}")
-                    
-                    print(f"Model not ready yet, attempt {i+1} of {max_retries}")
-                
-                raise Exception("Model failed to become ready after maximum retries")
-
-            except Exception as e:
-                print(f"Exception in switch_task: {str(e)}")
-                raise Exception(f"Error switching model: {str(e)}")
-
-        # Disable UI during model switch
-        self.model_combo.setEnabled(False)
-        self.generate_button.setEnabled(False)
-        self.status_label.setText("Switching model...")
-        self.status_label.setStyleSheet("color: orange")
-
-        # Create and start worker thread with keyword arguments
-        self.worker = WorkerThread(
-            task_func=switch_task,
-            model_name=model_name,
-            api_url=self.api_url,
-            api_key=self.api_key
-        )
-        self.worker.finished.connect(self.on_switch_complete)
-        self.worker.error.connect(self.on_switch_error)
-        self.worker.start()
-
-    def get_current_model(self):
-        """Get currently loaded model from server"""
-        try:
-            api_url = self.api_url.rstrip('/') + '/v1/chat/completions'
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'accept': 'application/json',
-                'Content-Type': 'application/json'
-            }
-            
-            payload = {
-                "messages": [],
-                "max_tokens": 1
-            }
-            
-            response = requests.post(api_url, headers=headers, json=payload)
-            
-            if response.status_code == 200:
-                current_model = response.json().get('model')
-                if current_model:
-                    index = self.model_combo.findText(current_model)
-                    if index >= 0:
-                        self.model_combo.blockSignals(True)
-                        self.model_combo.setCurrentIndex(index)
-                        self.model_combo.blockSignals(False)
-        except Exception as e:
-            print(f"Error getting current model: {str(e)}")
-
-    def on_switch_complete(self, result):
-        print(f"Model switch completed successfully: {result}")
-        self.model_combo.setEnabled(True)
-        self.status_label.setText("Model loaded successfully")
-        self.status_label.setStyleSheet("color: green")
-        self.update_generate_button_state()
-
-    def on_switch_error(self, error_msg):
-        print(f"Error switching model: {error_msg}")
-        self.model_combo.setEnabled(True)
-        self.status_label.setText(f"Error: {error_msg}")
-        self.status_label.setStyleSheet("color: red")
-        self.get_current_model()
-
-    def batch_processing_finished(self, results):
-        # Re-enable buttons
-        self.select_button.setEnabled(True)
-        self.generate_button.setEnabled(True)
-        self.single_radio.setEnabled(True)
-        self.folder_radio.setEnabled(True)
-
-        # Show summary
-        summary = f"Processed {len(results)} images.\n\nResults have been saved as .caption files next to the images."
-        self.caption_text.setText(summary)
-
-    def batch_processing_error(self, error_message):
-        # Re-enable buttons
-        self.select_button.setEnabled(True)
-        self.generate_button.setEnabled(True)
-        self.single_radio.setEnabled(True)
-        self.folder_radio.setEnabled(True)
-
-        QMessageBox.critical(self, "Error", f"An error occurred during batch processing:\n{error_message}")
-
-    def load_config(self):
-        """Load API configuration from config.json"""
-        if os.path.exists('config.json'):
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-                self.api_url = config.get('api_url', 'http://127.0.0.1:5000')
-                self.api_key = config.get('api_key', '')
-
-    def show_config_dialog(self):
-        """Show the API configuration dialog"""
-        dialog = APIConfigDialog(self)
-        if dialog.exec_():
-            self.load_config()
-
-    def load_format_settings(self):
-        """Load format settings from config file"""
-        try:
-            if os.path.exists('format_config.json'):
-                with open('format_config.json', 'r') as f:
-                    config = json.load(f)
-                    self.tags_format = config.get('tags_format', '.txt')
-                    self.caption_format = config.get('caption_format', '.caption')
-        except Exception as e:
-            print(f"Error loading format settings: {e}")
-
-    def check_backend_status(self):
-        try:
-            base_url = self.api_url.split('/v1')[0]
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'accept': 'application/json'
-            }
-            
-            response = requests.get(base_url, headers=headers)
-            
-            if response.status_code != 500:
-                self.status_label.setText("Backend Status: Connected")
-                self.status_label.setStyleSheet("color: green")
-                self.update_generate_button_state()
-            else:
-                raise Exception("Backend not responding properly")
-        except Exception as e:
-            print(f"Backend connection error: {str(e)}")
-            self.status_label.setText("Backend Status: Not Connected")
-            self.status_label.setStyleSheet("color: red")
-            self.generate_button.setEnabled(False)
-
-    def select_folder(self):
-        """Handle folder selection"""
-        folder_path = QFileDialog.getExistingDirectory(
-            self,
-            "Select Folder with Images",
-            "",
-            QFileDialog.ShowDirsOnly
-        )
-        
-        if not folder_path:
-            return
-
-        # Get all image files in the folder
-        self.selected_files = []
-        for file in os.listdir(folder_path):
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-                self.selected_files.append(os.path.join(folder_path, file))
-
-        if not self.selected_files:
-            QMessageBox.warning(self, "No Images", "No supported image files found in the selected folder.")
-            return
-
-        self.current_image_path = None
-        self.caption_text.setText(f"Found {len(self.selected_files)} images. Click 'Generate Caption' to process them.")
-
-        # Show first image as preview
-        if self.selected_files:
-            self.show_preview(self.selected_files[0])
-        
-        self.update_generate_button_state()
-
-    def show_preview(self, image_path):
-        pixmap = QPixmap(image_path)
-        scaled_pixmap = pixmap.scaled(
-            self.image_label.size(),
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
-        )
-        self.image_label.setPixmap(scaled_pixmap)
-
-    def update_select_button(self):
-        """Update select button text based on selected mode"""
-        if self.single_radio.isChecked():
-            self.select_button.setText("Select Image")
-            self.is_batch_mode = False
-        else:
-            self.select_button.setText("Select Folder")
-            self.is_batch_mode = True
-
-    def handle_select(self):
-        """Handle selection based on current mode"""
-        if self.single_radio.isChecked():
-            self.upload_image()
-        else:
-            self.select_folder()
-
-    def upload_image(self):
-        """Handle single image selection"""
-        file_name, _ = QFileDialog.getOpenFileName(
-            self,
-            "Select Image",
-            "",
-            "Image Files (*.png *.jpg *.jpeg *.bmp)"
-        )
-        
-        if file_name:
-            self.current_image_path = file_name
-            self.selected_files = []
-            self.show_preview(file_name)
-            self.caption_text.clear()
-            self.update_generate_button_state()
-
-    def create_menu_bar(self):
-        menubar = self.menuBar()
-        
-        # Create Settings menu
-        settings_menu = menubar.addMenu("Settings")
-        
-        # Add Sampling action
-        sampling_action = settings_menu.addAction("Sampling")
-        sampling_action.triggered.connect(self.show_sampling_dialog)
-
-        # Add Configure API action
-        api_config_action = settings_menu.addAction("Configure API")
-        api_config_action.triggered.connect(self.show_config_dialog)
-        
-        # Add Caption Format action
-        format_action = settings_menu.addAction("Caption Format")
-        format_action.triggered.connect(self.show_format_dialog)
-
-    def show_format_dialog(self):
-        """Show the caption format configuration dialog"""
-        dialog = CaptionFormatDialog(self)
-        if dialog.exec_():
-            # Reload format settings
-            self.load_format_settings()
-
-    def show_sampling_dialog(self):
-        dialog = SamplingConfigDialog(self)
-        if dialog.exec_():
-            self.load_sampling_config()
-
-    def get_default_sampling_config(self):
-        """Get sampling config from model's generation_config.json if it exists"""
-        try:
-            # Look for generation_config.json in the backend/models directory
-            backend_path = Path("backend")
-            models_path = backend_path / "models"
-            
-            # Get first model directory (assuming it's the active one)
-            model_dirs = [d for d in models_path.iterdir() if d.is_dir()]
-            if model_dirs:
-                config_path = model_dirs[0] / "generation_config.json"
-                if config_path.exists():
-                    with open(config_path, 'r') as f:
-                        config = json.load(f)
-                        return {
-                            'temperature': config.get('temperature', 0.5),
-                            'top_p': config.get('top_p', 0.5),
-                            'top_k': config.get('top_k', 50),
-                            'max_tokens': 500  # This usually isn't in generation_config.json
-                        }
-        except Exception as e:
-            print(f"Error loading generation_config.json: {e}")
-        
-        # Fallback to default values if no config found or error occurs
-        return {
-            'temperature': 0.5,
-            'top_p': 0.5,
-            'top_k': 50,
-            'max_tokens': 500
-        }
-
-    def load_sampling_config(self):
-        """Load sampling configuration from sampling_config.json if it exists"""
-        if os.path.exists('sampling_config.json'):
-            with open('sampling_config.json', 'r') as f:
-                self.sampling_config = json.load(f)
-
-    def update_generate_button_state(self):
-        """Update generate button state based on current conditions"""
-        should_enable = False
-        
-        if self.is_batch_mode:
-            # Enable if we have files selected for batch mode
-            should_enable = len(self.selected_files) > 0
-        else:
-            # Enable if we have a single image selected
-            should_enable = self.current_image_path is not None
-
-        self.generate_button.setEnabled(should_enable)
-
-    def generate_caption(self):
-        if not self.api_url or not self.api_key:
-            QMessageBox.warning(self, "Configuration Missing", 
-                            "Please configure the API URL and Key first.")
-            self.show_config_dialog()
-            return
-
-        # Verify model is loaded before proceeding
-        try:
-            headers = {
-                'Authorization': f'Bearer {self.api_key}',
-                'accept': 'application/json',
-                'Content-Type': 'application/json'
-            }
-            
-            test_url = self.api_url.rstrip('/') + '/v1/chat/completions'
-            test_payload = {
-                "messages": [{"role": "user", "content": "test"}],
-                "max_tokens": 1
-            }
-            
-            test_response = requests.post(test_url, headers=headers, json=test_payload)
-            if test_response.status_code != 200:
-                QMessageBox.warning(self, "Model Not Ready", 
-                                "The model is not ready. Please wait a moment and try again.")
-                return
-        except Exception as e:
-            QMessageBox.warning(self, "Error", 
-                            f"Could not verify model status: {str(e)}")
-            return
-
-        selected_style = self.style_combo.currentText()
-        if selected_style == "Custom":
-            user_prompt = self.custom_prompt_input.text().strip()
-            if not user_prompt:
-                QMessageBox.warning(self, "Input Required", 
-                                "Please enter a custom prompt.")
-                return
-        else:
-            user_prompt = self.caption_styles[selected_style]
-
-        # Check if current model is ExLlamaV2
-        current_model = self.model_combo.currentText()
-        is_exl2 = "exl2" in current_model.lower()
-
-        # Use greedy sampling for ExLlamaV2 models
-        if is_exl2:
-            sampling_config = {
-                'temperature': 1.0,
-                'top_k': 1,
-                'top_p': 1.0,
-                'typical': 1.0,
-                'min_p': 0.0,
-                'mirostat': False,
-                'smoothing_factor': 0.0,
-                'tfs': 1.0,
-                'temperature_last': False,
-                'token_repetition_penalty': 1.0,
-                'token_frequency_penalty': 0.0,
-                'token_presence_penalty': 0.0,
-                'max_tokens': self.sampling_config.get('max_tokens', 500)
-            }
-        else:
-            sampling_config = self.sampling_config
-
-        if self.is_batch_mode and self.selected_files:
-            def batch_task(files, api_url, api_key, prompt, sampling_config, use_tags, prefix):
-                results = {}
-                for i, image_path in enumerate(tqdm(files, desc="Processing", ncols=70), 1):
-                    try:
-                        # Try to load tags if enabled
-                        current_prompt = prompt
-                        if use_tags:
-                            try:
-                                tags_path = os.path.splitext(image_path)[0] + '.txt'
-                                if os.path.exists(tags_path):
-                                    with open(tags_path, 'r', encoding='utf-8') as f:
-                                        tags = f.read().strip()
-                                        current_prompt += ' Also here are booru tags for better understanding of the picture, you can use them as reference.'
-                                        current_prompt += f' <tags>\n{tags}\n</tags>'
-                            except Exception as e:
-                                print(f"Error loading tags for {image_path}: {str(e)}")
-
-                        headers = {
-                            'Authorization': f'Bearer {api_key}',
-                            'accept': 'application/json',
-                            'Content-Type': 'application/json'
-                        }
-
-                        with open(image_path, 'rb') as img_file:
-                            image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-
-                        payload = {
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "image_url",
-                                            "image_url": {
-                                                "url": f"data:image/jpeg;base64,{image_base64}"
-                                            }
-                                        },
-                                        {
-                                            "type": "text",
-                                            "text": f"{current_prompt} [Request: {time.time()}]"  # Add timestamp
-                                        }
-                                    ]
-                                }
-                            ],
-                            **sampling_config
-                        }
-
-                        request_url = api_url.rstrip('/') + '/v1/chat/completions'
-                        response = requests.post(request_url, headers=headers, json=payload)
-
-                        if response.status_code == 200:
-                            result = response.json()
-                            if 'choices' in result and len(result['choices']) > 0:
-                                caption = result['choices'][0]['message']['content']
-                                
-                                # Add prefix to caption content if provided
-                                if prefix:
-                                    caption = f"{prefix}\n{caption}"
-                                    
-                                results[image_path] = caption
-
-                                # Save caption file with same name as image but .caption extension
-                                caption_path = os.path.splitext(image_path)[0] + '.caption'
-                                with open(caption_path, 'w', encoding='utf-8') as f:
-                                    f.write(caption)
-
-                    except Exception as e:
-                        print(f"Error processing {image_path}: {str(e)}")
-                        continue
-
-                return results
-
-            # Disable UI elements
-            self.select_button.setEnabled(False)
-            self.generate_button.setEnabled(False)
-            self.single_radio.setEnabled(False)
-            self.folder_radio.setEnabled(False)
-
-            # Create and start worker thread with corrected argument order
-            self.worker = BatchProcessThread(
-                api_url=self.api_url,
-                api_key=self.api_key,
-                image_files=self.selected_files,
-                user_prompt=user_prompt,
-                sampling_config=sampling_config,
-                use_tags=self.use_tags_checkbox.isChecked(),
-                prefix=self.prefix_input.text(),
-                tags_format=self.tags_format,  # Add this
-                caption_format=self.caption_format  # Add this
-            )
-            self.worker.finished.connect(self.batch_processing_finished)
-            self.worker.error.connect(self.batch_processing_error)
-            self.worker.start()
-        else:
-            # Single image processing
-            try:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'accept': 'application/json',
-                    'Content-Type': 'application/json'
-                }
-
-                # Try to load tags if enabled
-                if self.use_tags_checkbox.isChecked():
-                    try:
-                        tags_path = os.path.splitext(self.current_image_path)[0] + '.txt'
-                        if os.path.exists(tags_path):
-                            with open(tags_path, 'r', encoding='utf-8') as f:
-                                tags = f.read().strip()
-                                user_prompt += ' Also here are booru tags for better understanding of the picture, you can use them as reference.'
-                                user_prompt += f' <tags>\n{tags}\n</tags>'
-                    except Exception as e:
-                        print(f"Error loading tags: {str(e)}")
-
-                # Read and encode image
-                with open(self.current_image_path, 'rb') as img_file:
-                    image_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-
-                if self.use_tags_checkbox.isChecked():
-                    try:
-                        tags_path = os.path.splitext(self.current_image_path)[0] + self.tags_format
-                        if os.path.exists(tags_path):
-                            with open(tags_path, 'r', encoding='utf-8') as f:
-                                tags = f.read().strip()
-                                user_prompt += ' Also here are booru tags for better understanding of the picture, you can use them as reference.'
-                                user_prompt += f' <tags>\n{tags}\n</tags>'
-                    except Exception as e:
-                        print(f"Error loading tags: {str(e)}")
-
-                # Prepare the payload with sampling config
-                payload = {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{image_base64}"
-                                    }
-                                },
-                                {
-                                    "type": "text",
-                                    "text": f"{user_prompt} [Request: {time.time()}]"  # Add timestamp
-                                }
-                            ]
-                        }
-                    ],
-                    **sampling_config
-                }
-
-                api_url = self.api_url
-                if not api_url.endswith('/v1/chat/completions'):
-                    api_url = api_url.rstrip('/') + '/v1/chat/completions'
-
-                self.caption_text.setText("Generating caption...")
-                
-                response = requests.post(
-                    api_url,
-                    headers=headers,
-                    json=payload
-                )
-                
-                print(f"Status Code: {response.status_code}")
-                print(f"Response Headers: {response.headers}")
-                print(f"Response Body: {response.text}")
-                
-                if response.status_code == 200:
-                    try:
-                        result = response.json()
-                        if 'choices' in result and len(result['choices']) > 0:
-                            caption = result['choices'][0]['message']['content']
-                            
-                            # Add prefix to caption content if provided
-                            prefix = self.prefix_input.text().strip()
-                            if prefix:
-                                caption = f"{prefix}\n{caption}"
-                                
-                            self.caption_text.setText(caption)
-
-                            # Use the configured caption format
-                            caption_path = os.path.splitext(self.current_image_path)[0] + self.caption_format
-                            with open(caption_path, 'w', encoding='utf-8') as f:
-                                f.write(caption)  # Save with prefix included
-                        else:
-                            self.caption_text.setText("No caption generated")
-                    except ValueError:
-                        self.caption_text.setText(f"Error: Could not parse JSON response\n{response.text}")
-                else:
-                    self.caption_text.setText(f"Error: {response.status_code}\n{response.text}")
-                        
-            except Exception as e:
-                self.caption_text.setText(f"Error: {str(e)}")
-                print(f"Exception details: {str(e)}")
-
-    def update_generate_button_state(self):
-        """Update generate button state based on current conditions"""
-        should_enable = False
-        
-        if self.is_batch_mode:
-            # Enable if we have files selected for batch mode
-            should_enable = len(self.selected_files) > 0
-        else:
-            # Enable if we have a single image selected
-            should_enable = self.current_image_path is not None
-
-        # Add custom prompt validation
-        if should_enable and self.style_combo.currentText() == "Custom":
-            should_enable = bool(self.custom_prompt_input.text().strip())
-
+import functools
+import io
+import os
+import json
+import logging
+import mmap
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path  # Add this import
+from PySide6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,
+                              QLabel, QFileDialog, QTextEdit, QMessageBox, QComboBox,
+                              QDialog, QLineEdit, QFormLayout, QMenuBar,
+                              QMenu, QDoubleSpinBox, QSpinBox, QCheckBox, QRadioButton)
+from PySide6.QtCore import Qt, QTimer, Signal, QThread, QRunnable, QThreadPool
+from PySide6.QtGui import QPixmap, QImageReader
+import requests
+from requests.adapters import HTTPAdapter, Retry
+import base64
+try:
+    # SIMD (AVX2/AVX-512) encoder, drop-in compatible with stdlib base64
+    import pybase64 as _b64
+except ImportError:
+    _b64 = base64
+try:
+    # C serialiser, ~5-10x faster than stdlib json and emits bytes directly
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # Only needed for the optional pre-upload downscale
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+import time
+from src.worker_thread import WorkerThread
+
+logger = logging.getLogger(__name__)
+
+# Below this size mmap setup cost outweighs the saved copy
+_MMAP_THRESHOLD = 64 * 1024
+
+# (connect, read) for generation calls; reads are long because the
+# backend streams tokens for the whole caption before responding
+_REQUEST_TIMEOUT = (3.05, 120)
+
+# Static per-batch headers; auth/content-type live on the session
+_BATCH_HEADERS = {'Cache-Control': 'no-cache'}
+
+_IMAGE_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.bmp'})
+
+# One .format() call instead of three string concatenations per image
+_TAG_TMPL = (' Also here are booru tags for better understanding of the picture,'
+             ' you can use them as reference. <tags>\n{}\n</tags>')
+
+_EXT_MIME = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.bmp': 'image/bmp',
+    '.webp': 'image/webp'
+}
+
+def json_dumps_bytes(obj):
+    """Serialise to JSON bytes, via orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+def json_loads(data):
+    """Parse JSON from bytes/str, via orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def image_mime(path):
+    """MIME type for an image path; lets the backend skip transcoding"""
+    return _EXT_MIME.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+def b64encode_file(path):
+    """Base64-encode a file, returning ASCII bytes.
+
+    Large files are mmap'd so the encoder reads straight from the page
+    cache instead of through an intermediate bytes copy; small ones use
+    a plain read because the mmap setup cost dominates there. Base64 is
+    pure ASCII, so callers that need a str can decode cheaply -- the
+    hot batch path never does."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size >= _MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _b64.b64encode(mm)
+        return _b64.b64encode(f.read())
+
+@functools.lru_cache(maxsize=16)
+def _encode_image(path, mtime_ns):
+    """b64encode_file with a small cache for retry/re-caption paths.
+
+    Keyed by mtime so an edited image re-encodes; maxsize stays small
+    because each entry can be several MB -- this is not a batch cache."""
+    return b64encode_file(path)
+
+def encode_image_cached(path):
+    """Encode an image, reusing a recent encoding of the same file"""
+    return _encode_image(path, os.stat(path).st_mtime_ns)
+
+# Vision backends downsample internally to roughly this edge anyway, so
+# anything larger just burns upload bandwidth
+_DOWNSCALE_EDGE = 1024
+
+@functools.lru_cache(maxsize=16)
+def _downscale_jpeg(path, mtime_ns, max_edge):
+    """Re-encode an image as a JPEG no larger than max_edge per side"""
+    im = PILImage.open(path)
+    im.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+    buf = io.BytesIO()
+    im.convert('RGB').save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+def encode_for_upload(path, downscale=False):
+    """Base64 bytes plus MIME type for an image upload.
+
+    With downscale enabled (and Pillow available) large photos are
+    re-encoded to a bounded JPEG first, typically shrinking request
+    bodies by 5-20x for camera images."""
+    if downscale and PILImage is not None:
+        try:
+            jpeg = _downscale_jpeg(path, os.stat(path).st_mtime_ns,
+                                   _DOWNSCALE_EDGE)
+            return _b64.b64encode(jpeg), 'image/jpeg'
+        except Exception as e:
+            logger.error(f"Error downscaling {path}, sending original: {str(e)}")
+    return b64encode_file(path), image_mime(path)
+
+# path -> (mtime, parsed dict); the config files only ever change via
+# the Save buttons in this app, so mtime checks make re-reads free
+_CONFIG_CACHE = {}
+
+def load_json_cached(path):
+    """Load a small JSON config with an mtime-validated in-memory cache.
+
+    Returns None if the file doesn't exist."""
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    data = json.loads(Path(path).read_bytes())
+    _CONFIG_CACHE[path] = (mtime, data)
+    return data
+
+def save_json_config(path, config):
+    """Atomically write a JSON config and refresh the cache entry"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(config, f)
+    os.replace(tmp_path, path)
+    try:
+        _CONFIG_CACHE[path] = (os.stat(path).st_mtime, config)
+    except OSError:
+        pass
+
+def write_caption_file(path, caption):
+    """Write a caption with raw os calls.
+
+    Skips the TextIOWrapper/BufferedWriter stack; one open, one write,
+    one close per file, which matters on batches of thousands."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, caption.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def make_session(api_key):
+    """Create a requests.Session with connection pooling and retries.
+
+    Every call in the app hits the same backend host, so reusing pooled
+    connections avoids a fresh TCP/TLS handshake per request."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3, connect=2, read=2,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'POST'])
+        )
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Authorization': f'Bearer {api_key}',
+        'accept': 'application/json',
+        'Content-Type': 'application/json'
+    })
+    return session
+
+class RateLimiter:
+    """Spaces out requests so batch workers stay under a global RPS cap.
+
+    Workers reserve the next send slot under the lock and sleep outside
+    it, so a slow backend never serialises the pool behind the limiter."""
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+class PreviewLoader(QRunnable):
+    """Decodes and scales a preview image off the GUI thread"""
+
+    def __init__(self, window, image_path, target_size, cache_key):
+        super().__init__()
+        self.window = window
+        self.image_path = image_path
+        self.target_size = target_size
+        self.cache_key = cache_key
+
+    def run(self):
+        # Decode straight to preview resolution: for JPEG this is
+        # DCT-domain scaling inside libjpeg, never materialising the
+        # full-resolution image in memory
+        reader = QImageReader(self.image_path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid():
+            size.scale(self.target_size, Qt.KeepAspectRatio)
+            reader.setScaledSize(size)
+        self.window.preview_ready.emit(self.cache_key, reader.read())
+
+class ModelComboBox(QComboBox):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.parent = parent
+
+    def mousePressEvent(self, event):
+        if self.count() == 1 and self.currentText() == "Add new model...":
+            logger.debug("Empty state click detected, showing download dialog...")
+            from src.model_download import ModelDownloadDialog
+            dialog = ModelDownloadDialog(self.parent)
+            dialog.setWindowTitle("Download New Model")
+            dialog.setModal(True)
+            if dialog.exec():
+                logger.debug("Model download dialog accepted")
+                self.parent.refresh_models()
+        else:
+            super().mousePressEvent(event)
+
+class CaptionFormatDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Caption Format Settings")
+        self.setModal(True)
+        self.setMinimumWidth(300)
+        
+        layout = QFormLayout(self)
+        
+        # Create input fields
+        self.tags_format = QLineEdit()
+        self.caption_format = QLineEdit()
+        
+        # Load saved settings or use defaults
+        self.load_settings()
+        
+        # Add fields to layout
+        layout.addRow("Reference Tags Format:", self.tags_format)
+        layout.addRow("Caption Save Format:", self.caption_format)
+        
+        # Add help text
+        help_text = QLabel("Enter file extensions (e.g., .txt, .caption)")
+        help_text.setStyleSheet("color: gray;")
+        layout.addRow(help_text)
+        
+        # Add save button
+        save_button = QPushButton("Save")
+        save_button.clicked.connect(self.save_settings)
+        layout.addRow(save_button)
+    
+    def load_settings(self):
+        """Load format settings from file"""
+        try:
+            config = load_json_cached('format_config.json')
+            if config is not None:
+                self.tags_format.setText(config.get('tags_format', '.txt'))
+                self.caption_format.setText(config.get('caption_format', '.caption'))
+            else:
+                # Set defaults
+                self.tags_format.setText('.txt')
+                self.caption_format.setText('.caption')
+        except Exception as e:
+            logger.error(f"Error loading format settings: {e}")
+            # Set defaults on error
+            self.tags_format.setText('.txt')
+            self.caption_format.setText('.caption')
+    
+    def save_settings(self):
+        """Save format settings to file"""
+        try:
+            config = {
+                'tags_format': self.tags_format.text().strip(),
+                'caption_format': self.caption_format.text().strip()
+            }
+            
+            # Validate formats
+            for fmt in config.values():
+                if not fmt.startswith('.'):
+                    QMessageBox.warning(self, "Invalid Format", 
+                                     "File formats must start with a dot (.)")
+                    return
+            
+            save_json_config('format_config.json', config)
+
+            self.accept()
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to save settings: {str(e)}")
+
+class BatchProcessThread(QThread):
+    progress = Signal(int, int)
+    finished = Signal(dict)
+    error = Signal(str)
+
+    def __init__(self, **kwargs):
+        super().__init__()
+        self.api_base = kwargs.get('api_base')
+        self.api_key = kwargs.get('api_key')
+        self.image_files = kwargs.get('image_files')
+        self.user_prompt = kwargs.get('user_prompt')
+        self.sampling_config = kwargs.get('sampling_config')
+        self.use_tags = kwargs.get('use_tags')
+        self.prefix = kwargs.get('prefix', '').strip()
+        self.tags_format = kwargs.get('tags_format', '.txt')
+        self.caption_format = kwargs.get('caption_format', '.caption')
+        self.max_workers = kwargs.get('max_workers', 4)
+        # Images per request; >1 amortises HTTP and model-prefill cost
+        # across a group but needs a backend that follows the separator
+        # prompt, so it stays opt-in
+        self.batch_size = max(1, kwargs.get('batch_size', 1))
+        # Global requests-per-second cap shared by all workers; 0 means
+        # unthrottled (local backends rarely rate-limit)
+        max_rps = kwargs.get('max_rps', 0)
+        self.rate_limiter = RateLimiter(max_rps) if max_rps else None
+        self.downscale = kwargs.get('downscale', False)
+        self.supports_multipart = kwargs.get('supports_multipart', False)
+        self.tag_paths = kwargs.get('tag_paths') or {}
+        # Derive output paths up front so the hot path never calls splitext
+        self.caption_paths = {path: os.path.splitext(path)[0] + self.caption_format
+                              for path in self.image_files}
+        # Pre-size with every key so the dict never rehashes mid-batch;
+        # failed images simply keep their None placeholder
+        self.results = dict.fromkeys(self.image_files)
+        self.results_lock = threading.Lock()
+        # Reuse the caller's pooled session when given one so batches
+        # inherit already-warm keep-alive connections; otherwise own one
+        # and close it when the batch ends
+        session = kwargs.get('session')
+        self._owns_session = session is None
+        self.session = session if session is not None else make_session(self.api_key)
+        # Set from the GUI thread to stop the batch at the next stage
+        # boundary; work already in flight still completes
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Request the batch to stop; safe to call from any thread"""
+        self.cancel_event.set()
+
+    def _process_one(self, image_path):
+        """Process a single image; returns (image_path, caption or None)"""
+        if self.cancel_event.is_set():
+            return image_path, None
+        try:
+            logger.debug("\nProcessing image: %s", image_path)
+
+            # Try to load tags if enabled; paths were resolved by a single
+            # directory scan before the batch started
+            prompt = self.user_prompt
+            if self.use_tags:
+                tags_path = self.tag_paths.get(image_path)
+                if tags_path:
+                    try:
+                        with open(tags_path, 'r', encoding='utf-8') as f:
+                            tags = f.read().strip()
+                        if tags:
+                            prompt = self.user_prompt + _TAG_TMPL.format(tags)
+                        logger.debug("Loaded tags for %s", image_path)
+                    except Exception as e:
+                        logger.error(f"Error loading tags for {image_path}: {str(e)}")
+
+            # Only the request ID varies per image; everything else lives
+            # on the session or in _BATCH_HEADERS
+            headers = {
+                **_BATCH_HEADERS,
+                'X-Request-ID': f'{time.time()}_{os.path.basename(image_path)}'
+            }
+
+            logger.debug("Sending request for %s", image_path)
+
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            response = None
+            if self.supports_multipart:
+                # Backend takes raw image parts: bytes-on-wire drop from
+                # 4/3*N to N and the base64 pass disappears entirely.
+                payload = dict(self.base_payload)
+                payload["messages"] = [
+                    {
+                        "role": "system",
+                        "content": f"Processing image: {os.path.basename(image_path)}"
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": prompt
+                            }
+                        ]
+                    }
+                ]
+
+                with open(image_path, 'rb') as img_file:
+                    response = self.session.post(
+                        self.request_url,
+                        # Let requests set the multipart boundary header
+                        headers={**headers, 'Content-Type': None},
+                        timeout=_REQUEST_TIMEOUT,
+                        data={'messages': json.dumps(payload)},
+                        files={'image': (os.path.basename(image_path), img_file, image_mime(image_path))}
+                    )
+                if response.status_code != 200:
+                    # The capability probe can be wrong (a backend may
+                    # serve /v1/files yet reject multipart chat posts);
+                    # fall back to the data-URI wire format, the same way
+                    # _process_group falls back to _process_one. One
+                    # rejection means they all would be, so stop paying
+                    # for a doomed raw upload on every remaining image.
+                    logger.error(f"Multipart upload rejected with status {response.status_code} "
+                                 f"for {image_path}; using data URIs for the rest of the batch")
+                    self.supports_multipart = False
+                    response = None
+            if response is None:
+                b64_bytes, mime = encode_for_upload(image_path, self.downscale)
+                logger.debug("Base64 length: %s", len(b64_bytes))
+
+                messages = [
+                    {
+                        "role": "system",
+                        "content": f"Processing image: {os.path.basename(image_path)}"
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": "__B64_PAYLOAD__"
+                                }
+                            },
+                            {
+                                "type": "text",
+                                "text": prompt
+                            }
+                        ]
+                    }
+                ]
+
+                # Serialise only the per-image messages, then splice the
+                # ASCII base64 bytes and the pre-serialised sampling
+                # fragment straight into the body. The multi-MB image
+                # never round-trips through a Python str or a second
+                # UTF-8 encode inside requests, and identical sampling
+                # keys aren't re-walked per image.
+                head, tail = json_dumps_bytes(messages).split(b'"__B64_PAYLOAD__"', 1)
+                body = b''.join((
+                    b'{"messages":', head,
+                    b'"data:', mime.encode('ascii'),
+                    b';base64,', b64_bytes, b'"',
+                    tail, self.sampling_tail
+                ))
+
+                response = self.session.post(self.request_url, headers=headers,
+                                             data=body, timeout=_REQUEST_TIMEOUT)
+            if logger.isEnabledFor(logging.DEBUG):
+                # response.text decodes the full body; skip unless DEBUG
+                logger.debug("Response for %s: status=%s headers=%s body=%.200s",
+                             image_path, response.status_code,
+                             response.headers, response.text)
+
+            if response.status_code == 200:
+                result = json_loads(response.content)
+                if 'choices' in result and len(result['choices']) > 0:
+                    caption = result['choices'][0]['message']['content']
+
+                    if self.prefix:
+                        caption = f"{self.prefix}\n{caption}"
+
+                    # Hand the write to the writer thread so a slow disk
+                    # (or network FS) never stalls the network loop
+                    self._write_q.put((self.caption_paths[image_path], caption))
+
+                    return image_path, caption
+                logger.error(f"No choices in response for {image_path}")
+            else:
+                logger.error(f"Request for {image_path} failed with status {response.status_code}")
+
+        except requests.exceptions.Timeout:
+            # One slow image must not abort the batch; record the miss
+            # and let the remaining workers keep going
+            logger.error(f"Timed out waiting for caption of {image_path}")
+        except Exception as e:
+            logger.error(f"Error processing image {image_path}: {str(e)}")
+
+        return image_path, None
+
+    def _process_group(self, paths):
+        """Caption several images with one request.
+
+        Returns a list of (path, caption or None). Any group whose
+        response cannot be split back into exactly one caption per image
+        falls back to individual requests, so a backend that ignores the
+        separator prompt costs one wasted call, never wrong captions."""
+        if len(paths) == 1:
+            return [self._process_one(paths[0])]
+        if self.cancel_event.is_set():
+            return [(path, None) for path in paths]
+        try:
+            content = []
+            for path in paths:
+                b64_bytes, mime = encode_for_upload(path, self.downscale)
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": "data:%s;base64,%s" % (mime, b64_bytes.decode('ascii'))
+                    }
+                })
+            content.append({
+                "type": "text",
+                "text": (f"{self.user_prompt} Caption each image in order."
+                         " Separate the captions with a line containing"
+                         " only '---'.")
+            })
+            payload = dict(self.base_payload)
+            payload["messages"] = [{"role": "user", "content": content}]
+
+            headers = {
+                **_BATCH_HEADERS,
+                'X-Request-ID': f'{time.time()}_group{len(paths)}'
+            }
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            response = self.session.post(self.request_url, headers=headers,
+                                         data=json_dumps_bytes(payload),
+                                         timeout=_REQUEST_TIMEOUT)
+            if response.status_code == 200:
+                result = json_loads(response.content)
+                if 'choices' in result and len(result['choices']) > 0:
+                    text = result['choices'][0]['message']['content']
+                    captions = [c.strip() for c in text.split('---') if c.strip()]
+                    if len(captions) == len(paths):
+                        out = []
+                        for path, caption in zip(paths, captions):
+                            if self.prefix:
+                                caption = f"{self.prefix}\n{caption}"
+                            self._write_q.put((self.caption_paths[path], caption))
+                            out.append((path, caption))
+                        return out
+                logger.error(f"Grouped response did not split into {len(paths)} captions; retrying individually")
+            else:
+                logger.error(f"Group request failed with status {response.status_code}; retrying individually")
+        except requests.exceptions.Timeout:
+            logger.error(f"Timed out waiting for captions of a {len(paths)}-image group")
+        except Exception as e:
+            logger.error(f"Error processing image group: {str(e)}")
+
+        return [self._process_one(path) for path in paths]
+
+    def _caption_writer(self):
+        """Drain caption writes queued by the workers.
+
+        Runs on its own daemon thread so disk I/O overlaps the network
+        round-trips instead of serialising behind them.
+        """
+        while True:
+            item = self._write_q.get()
+            if item is None:
+                break
+            path, caption = item
+            try:
+                write_caption_file(path, caption)
+                logger.debug("Saved caption for %s", path)
+            except Exception as e:
+                logger.error(f"Error writing caption {path}: {str(e)}")
+
+    def run(self):
+        writer = None
+        try:
+            self.request_url = self.api_base + '/v1/chat/completions'
+            # Sampling keys are identical for every image; merge them once
+            # here instead of re-splatting the dict per request. Workers
+            # only add their own per-image "messages" entry.
+            self.base_payload = dict(self.sampling_config)
+            # Serialised once and appended to every body byte-for-byte
+            sampling_frag = json_dumps_bytes(self.sampling_config)[1:-1]
+            self.sampling_tail = b',' + sampling_frag + b'}' if sampling_frag else b'}'
+            total = len(self.image_files)
+
+            # Resume support: images that already have a caption file are
+            # skipped outright, so re-running a partially failed batch
+            # only pays for the misses
+            pending = [path for path in self.image_files
+                       if not os.path.exists(self.caption_paths[path])]
+            skipped = total - len(pending)
+            if skipped:
+                logger.info("Skipping %d images with existing captions", skipped)
+
+            workers = max(1, min(self.max_workers, len(pending) or 1))
+
+            self._write_q = queue.Queue(maxsize=total or 1)
+            writer = threading.Thread(target=self._caption_writer, daemon=True)
+            writer.start()
+
+            # Grouping only applies on the plain JSON path; per-image
+            # tags and multipart uploads both need one image per request
+            if self.batch_size > 1 and not self.use_tags and not self.supports_multipart:
+                units = [pending[i:i + self.batch_size]
+                         for i in range(0, len(pending), self.batch_size)]
+            else:
+                units = [[path] for path in pending]
+
+            # The session is shared across workers; requests.Session is
+            # thread-safe for concurrent posts.
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._process_group, unit)
+                           for unit in units]
+                # Coalesce progress to ~30 Hz; a fast backend would
+                # otherwise flood the GUI thread with queued label
+                # updates and repaints
+                done = skipped
+                if skipped:
+                    self.progress.emit(done, total)
+                last_emit = 0.0
+                for future in as_completed(futures):
+                    for image_path, caption in future.result():
+                        done += 1
+                        if caption:
+                            with self.results_lock:
+                                self.results[image_path] = caption
+                    now = time.monotonic()
+                    if now - last_emit > 0.033 or done == total:
+                        self.progress.emit(done, total)
+                        last_emit = now
+
+            # Flush any writes still queued before reporting completion
+            self._write_q.put(None)
+            writer.join()
+            writer = None
+
+            results = {k: v for k, v in self.results.items() if v is not None}
+            logger.info("Completed processing %d images", len(results))
+            self.finished.emit(results)
+        except Exception as e:
+            logger.error("Thread error: %s", e)
+            self.error.emit(str(e))
+        finally:
+            if writer is not None:
+                # A failed batch must still unblock the writer and drain
+                # pending captions, or the daemon thread parks in q.get()
+                # forever
+                self._write_q.put(None)
+                writer.join()
+            if self._owns_session:
+                self.session.close()
+
+class APIConfigDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("API Configuration")
+        self.setModal(True)
+        
+        layout = QFormLayout(self)
+        
+        self.api_url = QLineEdit(self)
+        self.api_key = QLineEdit(self)
+        
+        # Set default API URL
+        self.api_url.setText("http://127.0.0.1:5000")
+        
+        # Load saved configuration if exists
+        config = load_json_cached('config.json')
+        if config is not None:
+            self.api_url.setText(config.get('api_url', 'http://127.0.0.1:5000'))
+            self.api_key.setText(config.get('api_key', ''))
+        
+        layout.addRow("API URL:", self.api_url)
+        layout.addRow("API Key:", self.api_key)
+        
+        save_button = QPushButton("Save")
+        save_button.clicked.connect(self.save_config)
+        layout.addRow(save_button)
+    
+    def save_config(self):
+        config = {
+            'api_url': self.api_url.text(),
+            'api_key': self.api_key.text()
+        }
+        save_json_config('config.json', config)
+        self.accept()
+
+class SamplingConfigDialog(QDialog):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Sampling Configuration")
+        self.setModal(True)
+        self.setMinimumWidth(400)
+        
+        layout = QFormLayout(self)
+        
+        # Create spin boxes for each parameter with smaller minimums and more decimals
+        self.temperature = QDoubleSpinBox()
+        self.temperature.setRange(0.0, 2.0)
+        self.temperature.setSingleStep(0.001)  # Smaller step
+        self.temperature.setDecimals(4)        # More decimal places
+        
+        self.top_p = QDoubleSpinBox()
+        self.top_p.setRange(0.0, 1.0)
+        self.top_p.setSingleStep(0.001)        # Smaller step
+        self.top_p.setDecimals(4)              # More decimal places
+        
+        self.top_k = QSpinBox()
+        self.top_k.setRange(0, 100)
+        
+        self.max_tokens = QSpinBox()
+        self.max_tokens.setRange(1, 2000)
+
+        self.max_workers = QSpinBox()
+        self.max_workers.setRange(1, 16)
+
+        # Add tooltips with updated information
+        self.temperature.setToolTip("Controls randomness. Higher values make output more random, lower values make it more deterministic. Can be very small (e.g., 0.001)")
+        self.top_p.setToolTip("Controls diversity. Lower values make output more focused. Can be very small (e.g., 0.001)")
+        self.top_k.setToolTip("Limits the number of tokens to sample from. 0 means no limit.")
+        self.max_tokens.setToolTip("Maximum number of tokens to generate.")
+        self.max_workers.setToolTip("Number of images to caption in parallel in batch mode.")
+
+        # Add widgets to layout
+        layout.addRow("Temperature:", self.temperature)
+        layout.addRow("Top P:", self.top_p)
+        layout.addRow("Top K:", self.top_k)
+        layout.addRow("Max Tokens:", self.max_tokens)
+        layout.addRow("Batch Workers:", self.max_workers)
+        
+        # Add save button
+        save_button = QPushButton("Save")
+        save_button.clicked.connect(self.save_config)
+        layout.addRow(save_button)
+        
+        # Load values
+        self.load_config()
+
+    def load_config(self):
+        """Load current sampling configuration"""
+        # Get values from parent window's sampling_config
+        config = self.parent().sampling_config
+        self.temperature.setValue(config.get('temperature', 0.5))
+        self.top_p.setValue(config.get('top_p', 0.5))
+        self.top_k.setValue(config.get('top_k', 50))
+        self.max_tokens.setValue(config.get('max_tokens', 500))
+        self.max_workers.setValue(config.get('max_workers', 4))
+
+    def save_config(self):
+        config = {
+            'temperature': self.temperature.value(),
+            'top_p': self.top_p.value(),
+            'top_k': self.top_k.value(),
+            'max_tokens': self.max_tokens.value(),
+            'max_workers': self.max_workers.value()
+        }
+        save_json_config('sampling_config.json', config)
+        self.accept()
+
+class MainWindow(QMainWindow):
+    # Emitted from the probe worker; queued back onto the GUI thread
+    # (connected, loaded model name) from the periodic health poll
+    backend_status_changed = Signal(bool, object)
+    # (cache_key, QImage) from PreviewLoader workers
+    preview_ready = Signal(object, object)
+
+    _THUMB_CACHE_SIZE = 64
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Image Caption Generator")
+        self.setMinimumSize(800, 600)
+        
+        # Initialize class variables
+        self.current_image_path = None
+        self.selected_files = []
+        self.is_batch_mode = False  # Initialize here
+        self.supports_multipart = None  # Probed on first backend contact
+        self.batch_worker = None  # Running BatchProcessThread, if any
+        
+        # Define caption styles
+        self.caption_styles = {
+            "JSON Format": "Describe the picture in structured json-like format.",
+            "Detailed": "Give a long and detailed description of the picture.",
+            "Brief": "Describe the picture briefly.",
+            "Custom": ""  # Empty string as we'll use custom input
+        }
+        
+        # Initialize API configuration
+        self.api_url = 'http://127.0.0.1:5000'
+        self.api_key = ''
+        self.load_config()
+
+        # Shared session for all backend calls (keep-alive + pooling)
+        self.http = make_session(self.api_key)
+
+        # Single-worker pool so status probes never block the event loop
+        self._probe_pool = ThreadPoolExecutor(max_workers=1)
+        self.backend_status_changed.connect(self.on_backend_status)
+
+        # Last /health poll result, shared by every status consumer so
+        # one periodic request serves them all
+        self._backend_state = {'healthy': None, 'model': None, 'ts': 0.0}
+
+        # monotonic time of the last successful generation probe; lets
+        # repeated Generate clicks skip the verification round-trip
+        self._ready_at = 0.0
+
+        # Poll back-off bookkeeping: identical results slow the timer
+        # down, any change (or user activity) speeds it back up
+        self._last_poll_state = None
+        self._stable_polls = 0
+
+        # LRU of scaled preview pixmaps keyed on (path, mtime, label size)
+        self._thumb_cache = OrderedDict()
+        self._pending_preview_key = None
+        self.preview_ready.connect(self.on_preview_ready)
+        
+        # Initialize sampling config from model's config or defaults
+        self.sampling_config = self.get_default_sampling_config()
+        self.load_sampling_config()
+
+        # Initialize format settings
+        self.tags_format = '.txt'
+        self.caption_format = '.caption'
+        self.load_format_settings()        
+
+        # Create menu bar
+        self.create_menu_bar()
+        
+        # Create central widget and layout
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+        
+        # Create model selection layout
+        model_layout = QHBoxLayout()
+        model_layout.addStretch()
+
+        model_label = QLabel("Model:")
+        self.model_combo = ModelComboBox(self)
+        self.model_combo.setMinimumWidth(200)
+
+        # Add load button
+        self.load_model_button = QPushButton("Load")
+        self.load_model_button.clicked.connect(self.load_selected_model)
+        self.load_model_button.setToolTip("Load the selected model")
+
+        model_layout.addWidget(model_label)
+        model_layout.addWidget(self.model_combo)
+        model_layout.addWidget(self.load_model_button)
+
+        # Add model selection to layout
+        layout.addLayout(model_layout)
+        
+        # Model list and backend probes are deferred to _post_init so
+        # the window paints before any I/O happens
+        
+        # Add status indicator
+        self.status_label = QLabel("Checking backend status...")
+        self.status_label.setStyleSheet("color: orange")
+        layout.addWidget(self.status_label)
+        
+        # Create UI elements
+        self.image_label = QLabel()
+        self.image_label.setAlignment(Qt.AlignCenter)
+        self.image_label.setMinimumHeight(300)
+        self.image_label.setStyleSheet("border: 2px dashed gray;")
+        
+        # Create style selection combo box
+        style_layout = QHBoxLayout()
+        style_label = QLabel("Caption Style:")
+        self.style_combo = QComboBox()
+        self.style_combo.addItems(self.caption_styles.keys())
+        style_layout.addWidget(style_label)
+        style_layout.addWidget(self.style_combo)
+
+        # Add custom prompt input
+        self.custom_prompt_input = QLineEdit()
+        self.custom_prompt_input.setPlaceholderText("Enter your custom prompt here...")
+        self.custom_prompt_input.setMinimumWidth(200)
+        self.custom_prompt_input.hide()  # Hidden by default
+        style_layout.addWidget(self.custom_prompt_input)
+
+        style_layout.addStretch()
+        
+        # Create radio buttons and select button layout with prefix
+        mode_layout = QHBoxLayout()
+        
+        # Create radio buttons
+        self.single_radio = QRadioButton("Single Image")
+        self.folder_radio = QRadioButton("Folder")
+        self.single_radio.setChecked(True)  # Default to single image mode
+        
+        # Create select button
+        self.select_button = QPushButton("Select Image")
+        
+        # Create prefix input
+        prefix_label = QLabel("Prefix:")
+        self.prefix_input = QLineEdit()
+        self.prefix_input.setPlaceholderText("Optional prefix for saved files")
+        self.prefix_input.setMaximumWidth(150)  # Limit width
+        
+        # Add to horizontal layout
+        mode_layout.addWidget(self.single_radio)
+        mode_layout.addWidget(self.folder_radio)
+        mode_layout.addWidget(self.select_button)
+        mode_layout.addWidget(prefix_label)
+        mode_layout.addWidget(self.prefix_input)
+        mode_layout.addStretch()
+        
+        # Create checkbox for tags
+        self.use_tags_checkbox = QCheckBox("Use Reference Tags")
+        self.use_tags_checkbox.setToolTip("If checked, will look for matching .txt files with reference tags")
+
+        # Create checkbox for pre-upload downscaling
+        self.downscale_checkbox = QCheckBox("Downscale before upload")
+        self.downscale_checkbox.setToolTip("Resize images to max 1024px before sending. "
+                                           "Vision models downsample internally anyway, "
+                                           "so this shrinks uploads without hurting captions.")
+
+        self.generate_button = QPushButton("Generate Caption")
+        self.generate_button.setEnabled(False)
+        
+        self.caption_text = QTextEdit()
+        self.caption_text.setReadOnly(True)
+        self.caption_text.setPlaceholderText("Generated caption will appear here...")
+        
+        # Add widgets to layout
+        layout.addWidget(self.image_label)
+        layout.addLayout(style_layout)
+        layout.addLayout(mode_layout)
+        layout.addWidget(self.use_tags_checkbox)
+        layout.addWidget(self.downscale_checkbox)
+        layout.addWidget(self.generate_button)
+        layout.addWidget(self.caption_text)
+        
+        # Connect signals
+        self.select_button.clicked.connect(self.handle_select)
+        self.single_radio.toggled.connect(self.update_select_button)
+        self.folder_radio.toggled.connect(self.update_select_button)
+        self.generate_button.clicked.connect(self.generate_caption)
+        self.use_tags_checkbox.stateChanged.connect(self.update_generate_button_state)
+        self.style_combo.currentIndexChanged.connect(self.update_generate_button_state)
+        self.style_combo.currentTextChanged.connect(self.handle_style_selection) 
+
+        self.custom_prompt_input.textChanged.connect(self.update_generate_button_state)
+        
+        # One timer drives the single /health poll; connectivity and the
+        # loaded-model sync both consume its result
+        self.check_timer = QTimer()
+        self.check_timer.timeout.connect(self.check_backend_status)
+        self.check_timer.start(5000)
+
+        # Run the first model scan and status probe once the event loop
+        # is up, so first paint isn't stuck behind them
+        QTimer.singleShot(0, self._post_init)
+
+    def _post_init(self):
+        """Deferred startup work: everything that touches disk or network"""
+        logger.debug("Initializing models...")
+        self.refresh_models()
+        self.check_backend_status()
+
+    def load_selected_model(self):
+        """Load the model selected in the dropdown"""
+        selected_model = self.model_combo.currentText()
+        
+        # Don't attempt to load if it's the "Add new model..." option or separator
+        if not selected_model or selected_model == "Add new model..." or selected_model.startswith("-"):
+            QMessageBox.warning(self, "Invalid Selection", "Please select a valid model to load.")
+            return
+        
+        # Disable UI during model loading
+        self.model_combo.setEnabled(False)
+        self.load_model_button.setEnabled(False)
+        self.generate_button.setEnabled(False)
+        self.status_label.setText("Loading model...")
+        self.status_label.setStyleSheet("color: orange")
+        
+        # Create and start worker thread with keyword arguments
+        self.worker = WorkerThread(
+            task_func=self.switch_model_task,
+            model_name=selected_model,
+            api_url=self.api_base,
+            api_key=self.api_key
+        )
+        self.worker.finished.connect(self.on_switch_complete)
+        self.worker.error.connect(self.on_switch_error)
+        self.worker.start()
+
+    def switch_model_task(self, model_name, api_url, api_key):
+        """Task function to switch models (to be run in a worker thread)"""
+        try:
+            headers = {'X-Admin-Key': api_key}
+
+            # First check if a model is loaded
+            health_url = api_url + '/health'
+            health_response = self.http.get(health_url, headers=headers, timeout=5)
+            if health_response.status_code == 200:
+                # Properly unload the current model; the readiness poll
+                # below covers the settling time, no fixed sleep
+                logger.debug("Unloading current model...")
+                unload_url = api_url + '/v1/model/unload'
+                unload_response = self.http.post(unload_url, headers=headers, timeout=30)
+                logger.debug("Unload response: %s", unload_response.status_code)
+
+            # Load new model with vision enabled
+            load_url = api_url + '/v1/model/load'
+            payload = {
+                "model_name": model_name,
+                "vision": True
+            }
+
+            logger.debug("Loading model: %s with vision enabled", model_name)
+
+            # Use non-streaming request first to initiate load
+            init_response = self.http.post(load_url, headers=headers, json=payload,
+                                           timeout=_REQUEST_TIMEOUT)
+            if init_response.status_code != 200:
+                raise Exception(f"Error initiating model load: {init_response.text}")
+
+            # Wait for the model to become ready: exponential backoff from
+            # 100ms so a fast load is noticed almost immediately instead
+            # of burning fixed 2s sleeps
+            delay = 0.1
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                try:
+                    health_response = self.http.get(health_url, headers=headers, timeout=2)
+                    if health_response.status_code == 200:
+                        if health_response.json().get("status") == "healthy":
+                            logger.debug("Model %s verified ready", model_name)
+                            return {"status": "success", "model": model_name}
+                    # A server-hinted cadence overrides our backoff
+                    hint = health_response.headers.get('Retry-After')
+                    if hint:
+                        try:
+                            delay = max(0.1, float(hint))
+                        except ValueError:
+                            pass
+                except requests.RequestException as e:
+                    logger.debug("Health check failed, retrying: %s", e)
+
+                time.sleep(delay)
+                delay = min(delay * 1.5, 2.0)
+
+            raise Exception("Model failed to become ready within 60 seconds")
+
+        except Exception as e:
+            logger.debug("Exception in switch_model_task: %s", e)
+            raise Exception(f"Error switching model: {str(e)}")
+
+    def handle_style_selection(self, style):
+        """Handle caption style selection changes"""
+        if style == "Custom":
+            self.custom_prompt_input.show()
+        else:
+            self.custom_prompt_input.hide()
+
+    def refresh_models(self):
+        """Get list of available models and sync with currently loaded model"""
+        self.model_combo.clear()
+        
+        backend_path = Path("backend")
+        models_path = backend_path / "models"
+        
+        # Create models directory if it doesn't exist
+        models_path.mkdir(parents=True, exist_ok=True)
+        
+        # Block signals temporarily
+        self.model_combo.blockSignals(True)
+        
+        # Get list of installed models
+        models = []
+        if models_path.exists():
+            models = [d.name for d in models_path.iterdir() if d.is_dir()]
+        
+        # Add installed models if any
+        if models:
+            self.model_combo.addItems(models)
+            self.model_combo.addItem("-" * 30)  # Separator
+        
+        # Always add "Add new model..." option
+        self.model_combo.addItem("Add new model...")
+        
+        # Sync with the server's loaded model without ever blocking the
+        # GUI: use the poller's cached result when it is fresh, otherwise
+        # render the local list now and let the async probe select the
+        # loaded model when it reports back
+        if time.monotonic() - self._backend_state['ts'] < 2:
+            current_model = self._backend_state['model']
+            if current_model:
+                logger.debug("Server has model loaded: %s", current_model)
+                index = self.model_combo.findText(current_model)
+                if index >= 0:
+                    self.model_combo.setCurrentIndex(index)
+                else:
+                    logger.error(f"Warning: Loaded model {current_model} not found in available models")
+        else:
+            self.check_backend_status()
+
+        # Connect signal for model selection changes
+        try:
+            if hasattr(self, '_model_combo_connected'):
+                try:
+                    self.model_combo.currentTextChanged.disconnect(self.handle_model_selection)
+                except TypeError:
+                    pass
+            self.model_combo.currentTextChanged.connect(self.handle_model_selection)
+            self._model_combo_connected = True
+        except Exception as e:
+            logger.error(f"Error handling model combo signals: {str(e)}")
+        
+        # Unblock signals
+        self.model_combo.blockSignals(False)
+
+    def _fetch_backend_health(self):
+        """One /health round-trip; returns (healthy, model_name).
+
+        This is the only probe the app makes -- connectivity, the status
+        label and the loaded-model sync all read its result."""
+        healthy = False
+        current_model = None
+        health_response = self.http.get(
+            self.api_base + '/health', timeout=(1.0, 2.0))
+        healthy = health_response.status_code == 200
+        if healthy:
+            current_model = health_response.json().get('model_name')
+
+            if not current_model:
+                # Standard OpenAI model listing: a cheap JSON read, unlike
+                # the old empty-completion POST which could actually spin
+                # up a generation on some backends
+                models_response = self.http.get(
+                    self.api_base + '/v1/models', timeout=2.0)
+                if models_response.status_code == 200:
+                    data = models_response.json().get('data') or []
+                    if data:
+                        current_model = data[0].get('id')
+
+        self._backend_state = {'healthy': healthy, 'model': current_model,
+                               'ts': time.monotonic()}
+        return healthy, current_model
+
+    def handle_empty_combo_click(self, event):
+        """Handle clicks on the combo box when it's empty"""
+        if not any(d.is_dir() for d in (Path("backend") / "models").iterdir()):
+            logger.debug("Opening download dialog from empty state...")
+            from src.model_download import ModelDownloadDialog
+            dialog = ModelDownloadDialog(self)
+            dialog.setWindowTitle("Download New Model")
+            dialog.setModal(True)
+            if dialog.exec():
+                logger.debug("Model download dialog accepted")
+                # Remove the custom click handler
+                self.model_combo.mousePressEvent = self.model_combo.__class__.mousePressEvent
+                self.refresh_models()
+        # Call the original mousePressEvent
+        self.model_combo.__class__.mousePressEvent(self.model_combo, event)
+    
+    def _apply_model_selection(self, current_model):
+        """Sync the combo box with the model the server reports as loaded"""
+        if not current_model:
+            return
+        index = self.model_combo.findText(current_model)
+        if index >= 0 and index != self.model_combo.currentIndex():
+            self.model_combo.blockSignals(True)
+            self.model_combo.setCurrentIndex(index)
+            self.model_combo.blockSignals(False)
+            logger.debug("Updated current model to: %s", current_model)
+
+    def handle_model_selection(self, selection):
+        """Handle model selection including download option"""
+        logger.debug("handle_model_selection called with: %s", selection)
+        
+        # Ignore empty selections or initial state
+        if not selection:
+            return
+            
+        if selection == "Add new model...":
+            logger.debug("Opening download dialog...")
+            try:
+                from src.model_download import ModelDownloadDialog
+                dialog = ModelDownloadDialog(self)
+                dialog.setWindowTitle("Download New Model")
+                dialog.setModal(True)
+                result = dialog.exec()
+                logger.debug("Dialog result: %s", result)
+                
+                if result:
+                    logger.debug("Model download dialog accepted")
+                    self.refresh_models()
+                
+                # Reset selection to previous model if one exists
+                self.model_combo.blockSignals(True)
+                if self.model_combo.count() > 1:
+                    self.model_combo.setCurrentIndex(0)
+                self.model_combo.blockSignals(False)
+                
+            except Exception as e:
+                logger.error(f"Error in handle_model_selection: {str(e)}")
+                QMessageBox.critical(self, "Error", f"Failed to open model download dialog: {str(e)}")
+        # Remove the automatic model switching part that was here
+
+    def switch_model(self, model_name):
+        # Don't attempt to switch if model_name is empty or None
+        if not model_name or model_name == "Add new model...":
+            self.model_combo.setEnabled(True)
+            return
+
+        def switch_task(model_name, api_url, api_key):
+            try:
+                headers = {'X-Admin-Key': api_key}
+
+                # First check if a model is loaded
+                health_url = api_url + '/health'
+                health_response = self.http.get(health_url, headers=headers, timeout=5)
+                if health_response.status_code == 200:
+                    # Properly unload the current model; the readiness
+                    # poll below covers the settling time, no fixed sleep
+                    logger.debug("Unloading current model...")
+                    unload_url = api_url + '/v1/model/unload'
+                    unload_response = self.http.post(unload_url, headers=headers, timeout=30)
+                    logger.debug("Unload response: %s", unload_response.status_code)
+
+                # Load new model with vision enabled
+                load_url = api_url + '/v1/model/load'
+                payload = {
+                    "model_name": model_name,
+                    "vision": True
+                }
+
+                logger.debug("Loading model: %s with vision enabled", model_name)
+
+                # Use non-streaming request first to initiate load
+                init_response = self.http.post(load_url, headers=headers, json=payload,
+                                               timeout=_REQUEST_TIMEOUT)
+                if init_response.status_code != 200:
+                    raise Exception(f"Error initiating model load: {init_response.text}")
+
+                # Wait for the model to become ready: exponential backoff
+                # from 100ms so a fast load is noticed almost immediately
+                # instead of burning fixed 2s sleeps
+                delay = 0.1
+                deadline = time.monotonic() + 60
+                while time.monotonic() < deadline:
+                    try:
+                        health_response = self.http.get(health_url, headers=headers, timeout=2)
+                        if health_response.status_code == 200:
+                            if health_response.json().get("status") == "healthy":
+                                logger.debug("Model %s verified ready", model_name)
+                                return {"status": "success", "model": model_name}
+                        # A server-hinted cadence overrides our backoff
+                        hint = health_response.headers.get('Retry-After')
+                        if hint:
+                            try:
+                                delay = max(0.1, float(hint))
+                            except ValueError:
+                                pass
+                    except requests.RequestException as e:
+                        logger.debug("Health check failed, retrying: %s", e)
+
+                    time.sleep(delay)
+                    delay = min(delay * 1.5, 2.0)
+
+                raise Exception("Model failed to become ready within 60 seconds")
+
+            except Exception as e:
+                logger.debug("Exception in switch_task: %s", e)
+                raise Exception(f"Error switching model: {str(e)}")
+
+        # Disable UI during model switch
+        self.model_combo.setEnabled(False)
+        self.generate_button.setEnabled(False)
+        self.status_label.setText("Switching model...")
+        self.status_label.setStyleSheet("color: orange")
+
+        # Create and start worker thread with keyword arguments
+        self.worker = WorkerThread(
+            task_func=switch_task,
+            model_name=model_name,
+            api_url=self.api_base,
+            api_key=self.api_key
+        )
+        self.worker.finished.connect(self.on_switch_complete)
+        self.worker.error.connect(self.on_switch_error)
+        self.worker.start()
+
+    def get_current_model(self):
+        """Get currently loaded model from server"""
+        try:
+            api_url = self.api_base + '/v1/chat/completions'
+
+            payload = {
+                "messages": [],
+                "max_tokens": 1
+            }
+
+            response = self.http.post(api_url, json=payload, timeout=_REQUEST_TIMEOUT)
+            
+            if response.status_code == 200:
+                current_model = response.json().get('model')
+                if current_model:
+                    index = self.model_combo.findText(current_model)
+                    if index >= 0:
+                        self.model_combo.blockSignals(True)
+                        self.model_combo.setCurrentIndex(index)
+                        self.model_combo.blockSignals(False)
+        except Exception as e:
+            logger.error(f"Error getting current model: {str(e)}")
+
+    def on_switch_complete(self, result):
+        logger.debug("Model switch completed successfully: %s", result)
+        self._default_sampling_config = None  # new model, new defaults
+        self.model_combo.setEnabled(True)
+        self.status_label.setText("Model loaded successfully")
+        self.status_label.setStyleSheet("color: green")
+        self.update_generate_button_state()
+
+    def on_switch_error(self, error_msg):
+        logger.error(f"Error switching model: {error_msg}")
+        self.model_combo.setEnabled(True)
+        self.status_label.setText(f"Error: {error_msg}")
+        self.status_label.setStyleSheet("color: red")
+        self.get_current_model()
+
+    def cancel_batch(self):
+        """Stop the running batch; in-flight requests still finish"""
+        if self.batch_worker is not None and self.batch_worker.isRunning():
+            self.batch_worker.cancel()
+            self.generate_button.setEnabled(False)
+            self.caption_text.setText("Cancelling... waiting for in-flight requests to finish.")
+
+    def _restore_batch_ui(self):
+        """Re-enable controls and turn the Cancel button back into Generate"""
+        self.select_button.setEnabled(True)
+        self.single_radio.setEnabled(True)
+        self.folder_radio.setEnabled(True)
+        self.load_model_button.setEnabled(True)
+        self.generate_button.setText("Generate Caption")
+        self.generate_button.setEnabled(True)
+        self.generate_button.clicked.disconnect()
+        self.generate_button.clicked.connect(self.generate_caption)
+
+    def batch_processing_finished(self, results):
+        self._restore_batch_ui()
+
+        # Show summary
+        summary = f"Processed {len(results)} images.\n\nResults have been saved as .caption files next to the images."
+        self.caption_text.setText(summary)
+
+    def batch_processing_error(self, error_message):
+        # Force a fresh readiness probe on the next Generate click
+        self._ready_at = 0.0
+        self._restore_batch_ui()
+
+        QMessageBox.critical(self, "Error", f"An error occurred during batch processing:\n{error_message}")
+
+    def load_config(self):
+        """Load API configuration from config.json"""
+        config = load_json_cached('config.json')
+        if config is not None:
+            self.api_url = config.get('api_url', 'http://127.0.0.1:5000')
+            self.api_key = config.get('api_key', '')
+        # Normalised once here; endpoint builders just concatenate so a
+        # trailing slash in the saved config can't double up
+        self.api_base = self.api_url.rstrip('/')
+
+    def show_config_dialog(self):
+        """Show the API configuration dialog"""
+        dialog = APIConfigDialog(self)
+        if dialog.exec_():
+            self.load_config()
+            # Keep the shared session's auth in sync with the new config
+            self.http.headers['Authorization'] = f'Bearer {self.api_key}'
+            self._reset_poll_interval()
+
+    def load_format_settings(self):
+        """Load format settings from config file"""
+        try:
+            config = load_json_cached('format_config.json')
+            if config is not None:
+                self.tags_format = config.get('tags_format', '.txt')
+                self.caption_format = config.get('caption_format', '.caption')
+        except Exception as e:
+            logger.error(f"Error loading format settings: {e}")
+
+    def check_backend_status(self):
+        """Kick off a backend probe without blocking the GUI thread"""
+        self._probe_pool.submit(self._probe_backend)
+
+    def _reset_poll_interval(self):
+        """User activity: go back to prompt 5s polling for a while"""
+        self._stable_polls = 0
+        self.check_timer.setInterval(5000)
+
+    def _probe_backend(self):
+        """Runs on the probe pool; reports back via backend_status_changed"""
+        current_model = None
+        try:
+            connected, current_model = self._fetch_backend_health()
+
+            if connected and self.supports_multipart is None:
+                # One-time probe: backends exposing /v1/files can take
+                # raw multipart image uploads instead of base64 URIs
+                try:
+                    probe = self.http.get(
+                        self.api_base + '/v1/files', timeout=5)
+                    self.supports_multipart = probe.status_code < 400
+                except Exception:
+                    self.supports_multipart = False
+                logger.debug("Multipart upload support: %s", self.supports_multipart)
+        except Exception as e:
+            logger.error(f"Backend connection error: {str(e)}")
+            connected = False
+
+        self.backend_status_changed.emit(connected, current_model)
+
+    def on_backend_status(self, connected, current_model):
+        """GUI-thread slot for probe results"""
+        # Adaptive poll rate: after a minute of identical results the
+        # tick stretches to 30s; any change snaps it back to 5s
+        state = (connected, current_model)
+        if state == self._last_poll_state:
+            self._stable_polls += 1
+            if self._stable_polls >= 12:
+                self.check_timer.setInterval(30000)
+        else:
+            self._last_poll_state = state
+            self._stable_polls = 0
+            self.check_timer.setInterval(5000)
+
+        if connected:
+            self.status_label.setText("Backend Status: Connected")
+            self.status_label.setStyleSheet("color: green")
+            self.update_generate_button_state()
+            self._apply_model_selection(current_model)
+        else:
+            self.status_label.setText("Backend Status: Not Connected")
+            self.status_label.setStyleSheet("color: red")
+            self.generate_button.setEnabled(False)
+
+    def select_folder(self):
+        """Handle folder selection"""
+        folder_path = QFileDialog.getExistingDirectory(
+            self,
+            "Select Folder with Images",
+            "",
+            QFileDialog.ShowDirsOnly
+        )
+        
+        if not folder_path:
+            return
+
+        # Get all image files in the folder; scandir caches the file type
+        # from the directory read, so no extra stat per entry
+        with os.scandir(folder_path) as it:
+            self.selected_files = [
+                de.path for de in it
+                if de.is_file(follow_symlinks=False)
+                and os.path.splitext(de.name)[1].lower() in _IMAGE_EXTS
+            ]
+
+        if not self.selected_files:
+            QMessageBox.warning(self, "No Images", "No supported image files found in the selected folder.")
+            return
+
+        self.current_image_path = None
+        self.caption_text.setText(f"Found {len(self.selected_files)} images. Click 'Generate Caption' to process them.")
+
+        # Show first image as preview
+        if self.selected_files:
+            self.show_preview(self.selected_files[0])
+        
+        self.update_generate_button_state()
+
+    def show_preview(self, image_path):
+        try:
+            mtime = os.path.getmtime(image_path)
+        except OSError:
+            mtime = 0
+        key = (image_path, mtime, self.image_label.size().toTuple())
+        # Loads finish asynchronously and may arrive out of order; only
+        # the most recently requested key gets displayed
+        self._pending_preview_key = key
+
+        cached = self._thumb_cache.get(key)
+        if cached is not None:
+            self._thumb_cache.move_to_end(key)
+            self.image_label.setPixmap(cached)
+            return
+
+        # Decode + scale on the global pool; on_preview_ready sets the
+        # pixmap once the queued signal lands back on the GUI thread
+        QThreadPool.globalInstance().start(
+            PreviewLoader(self, image_path, self.image_label.size(), key))
+
+    def on_preview_ready(self, key, image):
+        """GUI-thread slot: cache and display a freshly scaled preview"""
+        if image.isNull():
+            return
+        pixmap = QPixmap.fromImage(image)
+        self._thumb_cache[key] = pixmap
+        while len(self._thumb_cache) > self._THUMB_CACHE_SIZE:
+            self._thumb_cache.popitem(last=False)
+        # A stale load (user already moved on) still gets cached above,
+        # but must not clobber the current selection's preview
+        if key == self._pending_preview_key:
+            self.image_label.setPixmap(pixmap)
+
+    def update_select_button(self):
+        """Update select button text based on selected mode"""
+        if self.single_radio.isChecked():
+            self.select_button.setText("Select Image")
+            self.is_batch_mode = False
+        else:
+            self.select_button.setText("Select Folder")
+            self.is_batch_mode = True
+
+    def handle_select(self):
+        """Handle selection based on current mode"""
+        if self.single_radio.isChecked():
+            self.upload_image()
+        else:
+            self.select_folder()
+
+    def upload_image(self):
+        """Handle single image selection"""
+        file_name, _ = QFileDialog.getOpenFileName(
+            self,
+            "Select Image",
+            "",
+            "Image Files (*.png *.jpg *.jpeg *.bmp)"
+        )
+        
+        if file_name:
+            self.current_image_path = file_name
+            self.selected_files = []
+            self.show_preview(file_name)
+            self.caption_text.clear()
+            self.update_generate_button_state()
+
+    def create_menu_bar(self):
+        menubar = self.menuBar()
+        
+        # Create Settings menu
+        settings_menu = menubar.addMenu("Settings")
+        
+        # Add Sampling action
+        sampling_action = settings_menu.addAction("Sampling")
+        sampling_action.triggered.connect(self.show_sampling_dialog)
+
+        # Add Configure API action
+        api_config_action = settings_menu.addAction("Configure API")
+        api_config_action.triggered.connect(self.show_config_dialog)
+        
+        # Add Caption Format action
+        format_action = settings_menu.addAction("Caption Format")
+        format_action.triggered.connect(self.show_format_dialog)
+
+    def show_format_dialog(self):
+        """Show the caption format configuration dialog"""
+        dialog = CaptionFormatDialog(self)
+        if dialog.exec_():
+            # Reload format settings
+            self.load_format_settings()
+
+    def show_sampling_dialog(self):
+        dialog = SamplingConfigDialog(self)
+        if dialog.exec_():
+            self.load_sampling_config()
+
+    def get_default_sampling_config(self):
+        """Get sampling config from model's generation_config.json if it exists.
+
+        Memoized per session; a model switch invalidates the cache since
+        the active model's defaults may differ."""
+        cached = getattr(self, '_default_sampling_config', None)
+        if cached is not None:
+            return cached
+
+        result = None
+        try:
+            # Look for generation_config.json in the backend/models directory
+            backend_path = Path("backend")
+            models_path = backend_path / "models"
+
+            # First model directory (assuming it's the active one); stop
+            # iterating as soon as one is found
+            model_dir = next((d for d in models_path.iterdir() if d.is_dir()), None)
+            if model_dir is not None:
+                config = load_json_cached(str(model_dir / "generation_config.json"))
+                if config is not None:
+                    result = {
+                        'temperature': config.get('temperature', 0.5),
+                        'top_p': config.get('top_p', 0.5),
+                        'top_k': config.get('top_k', 50),
+                        'max_tokens': 500  # This usually isn't in generation_config.json
+                    }
+        except Exception as e:
+            logger.error(f"Error loading generation_config.json: {e}")
+
+        if result is None:
+            # Fallback to default values if no config found or error occurs
+            result = {
+                'temperature': 0.5,
+                'top_p': 0.5,
+                'top_k': 50,
+                'max_tokens': 500
+            }
+        self._default_sampling_config = result
+        return result
+
+    def load_sampling_config(self):
+        """Load sampling configuration from sampling_config.json if it exists"""
+        config = load_json_cached('sampling_config.json')
+        if config is not None:
+            self.sampling_config = config
+
+    def update_generate_button_state(self):
+        """Update generate button state based on current conditions"""
+        should_enable = False
+        
+        if self.is_batch_mode:
+            # Enable if we have files selected for batch mode
+            should_enable = len(self.selected_files) > 0
+        else:
+            # Enable if we have a single image selected
+            should_enable = self.current_image_path is not None
+
+        self.generate_button.setEnabled(should_enable)
+
+    def generate_caption(self):
+        if not self.api_url or not self.api_key:
+            QMessageBox.warning(self, "Configuration Missing",
+                            "Please configure the API URL and Key first.")
+            self.show_config_dialog()
+            return
+
+        self._reset_poll_interval()
+
+        # Verify model is loaded before proceeding; a recent successful
+        # probe (or real generation) makes this click free of the extra
+        # round-trip
+        if time.monotonic() - self._ready_at >= 60:
+            try:
+                test_url = self.api_base + '/v1/chat/completions'
+                test_payload = {
+                    "messages": [{"role": "user", "content": "test"}],
+                    "max_tokens": 1
+                }
+
+                test_response = self.http.post(test_url, json=test_payload, timeout=(3.05, 30))
+                if test_response.status_code != 200:
+                    QMessageBox.warning(self, "Model Not Ready",
+                                    "The model is not ready. Please wait a moment and try again.")
+                    return
+                self._ready_at = time.monotonic()
+            except Exception as e:
+                QMessageBox.warning(self, "Error",
+                                f"Could not verify model status: {str(e)}")
+                return
+
+        selected_style = self.style_combo.currentText()
+        if selected_style == "Custom":
+            user_prompt = self.custom_prompt_input.text().strip()
+            if not user_prompt:
+                QMessageBox.warning(self, "Input Required", 
+                                "Please enter a custom prompt.")
+                return
+        else:
+            user_prompt = self.caption_styles[selected_style]
+
+        # Check if current model is ExLlamaV2
+        current_model = self.model_combo.currentText()
+        is_exl2 = "exl2" in current_model.lower()
+
+        # Use greedy sampling for ExLlamaV2 models
+        if is_exl2:
+            sampling_config = {
+                'temperature': 1.0,
+                'top_k': 1,
+                'top_p': 1.0,
+                'typical': 1.0,
+                'min_p': 0.0,
+                'mirostat': False,
+                'smoothing_factor': 0.0,
+                'tfs': 1.0,
+                'temperature_last': False,
+                'token_repetition_penalty': 1.0,
+                'token_frequency_penalty': 0.0,
+                'token_presence_penalty': 0.0,
+                'max_tokens': self.sampling_config.get('max_tokens', 500)
+            }
+        else:
+            # max_workers/batch_size drive the batch thread, not the sampler
+            sampling_config = {k: v for k, v in self.sampling_config.items()
+                               if k not in ('max_workers', 'batch_size', 'max_rps')}
+
+        if self.is_batch_mode and self.selected_files:
+            # Disable UI elements; Load stays off too so a mid-batch
+            # model switch can't yank the backend out from under the run
+            self.select_button.setEnabled(False)
+            self.generate_button.setEnabled(False)
+            self.single_radio.setEnabled(False)
+            self.folder_radio.setEnabled(False)
+            self.load_model_button.setEnabled(False)
+
+            # Resolve tag files with one directory scan instead of a
+            # splitext+exists probe per image inside the worker
+            tag_paths = {}
+            if self.use_tags_checkbox.isChecked():
+                folder = os.path.dirname(self.selected_files[0])
+                try:
+                    with os.scandir(folder) as it:
+                        names = {de.name for de in it}
+                    for image_path in self.selected_files:
+                        tag_name = os.path.splitext(os.path.basename(image_path))[0] + self.tags_format
+                        if tag_name in names:
+                            tag_paths[image_path] = os.path.join(folder, tag_name)
+                except Exception as e:
+                    logger.error(f"Error scanning for tag files: {str(e)}")
+
+            # Create and start worker thread with corrected argument order.
+            # Kept separate from self.worker (model switch / download) so
+            # neither can replace or orphan the other's live QThread
+            self.batch_worker = BatchProcessThread(
+                api_base=self.api_base,
+                api_key=self.api_key,
+                image_files=self.selected_files,
+                user_prompt=user_prompt,
+                sampling_config=sampling_config,
+                use_tags=self.use_tags_checkbox.isChecked(),
+                prefix=self.prefix_input.text(),
+                tags_format=self.tags_format,  # Add this
+                caption_format=self.caption_format,  # Add this
+                max_workers=self.sampling_config.get('max_workers', 4),
+                # Opt-in via sampling_config.json; most backends caption
+                # one image per request reliably, so this defaults to 1
+                batch_size=self.sampling_config.get('batch_size', 1),
+                max_rps=self.sampling_config.get('max_rps', 0),
+                downscale=self.downscale_checkbox.isChecked(),
+                supports_multipart=bool(self.supports_multipart),
+                tag_paths=tag_paths,
+                session=self.http
+            )
+            self.batch_worker.finished.connect(self.batch_processing_finished)
+            self.batch_worker.error.connect(self.batch_processing_error)
+            self.batch_worker.start()
+
+            # Repurpose the Generate button as Cancel for the duration
+            # of the batch; the thread stops at the next stage boundary
+            self.generate_button.setText("Cancel")
+            self.generate_button.setEnabled(True)
+            self.generate_button.clicked.disconnect()
+            self.generate_button.clicked.connect(self.cancel_batch)
+        else:
+            # Single image processing
+            try:
+                # Read and encode image, downscaled if requested; cached
+                # either way so re-captioning the same image (e.g. while
+                # tuning the prompt) skips the encode
+                if self.downscale_checkbox.isChecked() and PILImage is not None:
+                    image_b64_bytes, image_mime_type = encode_for_upload(
+                        self.current_image_path, downscale=True)
+                else:
+                    image_b64_bytes = encode_image_cached(self.current_image_path)
+                    image_mime_type = image_mime(self.current_image_path)
+                image_base64 = image_b64_bytes.decode('ascii')
+
+                # Try to load tags if enabled; EAFP, one open instead of
+                # a stat followed by an open
+                if self.use_tags_checkbox.isChecked():
+                    tags_path = os.path.splitext(self.current_image_path)[0] + self.tags_format
+                    try:
+                        with open(tags_path, 'r', encoding='utf-8') as f:
+                            tags = f.read().strip()
+                        if tags:
+                            user_prompt += _TAG_TMPL.format(tags)
+                    except FileNotFoundError:
+                        pass
+
+                # Prepare the payload with sampling config
+                payload = {
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "image_url",
+                                    "image_url": {
+                                        "url": f"data:{image_mime_type};base64,{image_base64}"
+                                    }
+                                },
+                                {
+                                    "type": "text",
+                                    # No per-request nonce: an identical
+                                    # prompt lets the backend reuse its
+                                    # cached prefix KV state
+                                    "text": user_prompt
+                                }
+                            ]
+                        }
+                    ],
+                    **sampling_config
+                }
+
+                api_url = self.api_base
+                if not api_url.endswith('/v1/chat/completions'):
+                    api_url = api_url + '/v1/chat/completions'
+
+                self.caption_text.setText("Generating caption...")
+                
+                response = self.http.post(
+                    api_url, data=json_dumps_bytes(payload),
+                    headers={'X-Request-ID': f'{time.time()}_{os.path.basename(self.current_image_path)}'},
+                    timeout=_REQUEST_TIMEOUT)
+                
+                if logger.isEnabledFor(logging.DEBUG):
+                    # response.text decodes the whole body; skip unless DEBUG
+                    logger.debug("Status Code: %s", response.status_code)
+                    logger.debug("Response Headers: %s", response.headers)
+                    logger.debug("Response Body: %s", response.text)
+                
+                if response.status_code == 200:
+                    try:
+                        result = json_loads(response.content)
+                        if 'choices' in result and len(result['choices']) > 0:
+                            caption = result['choices'][0]['message']['content']
+                            
+                            # Add prefix to caption content if provided
+                            prefix = self.prefix_input.text().strip()
+                            if prefix:
+                                caption = f"{prefix}\n{caption}"
+                                
+                            self.caption_text.setText(caption)
+
+                            # Use the configured caption format
+                            caption_path = os.path.splitext(self.current_image_path)[0] + self.caption_format
+                            write_caption_file(caption_path, caption)  # Save with prefix included
+                        else:
+                            self.caption_text.setText("No caption generated")
+                    except ValueError:
+                        self.caption_text.setText(f"Error: Could not parse JSON response\n{response.text}")
+                else:
+                    self.caption_text.setText(f"Error: {response.status_code}\n{response.text}")
+                        
+            except Exception as e:
+                # Force a fresh readiness probe on the next click
+                self._ready_at = 0.0
+                self.caption_text.setText(f"Error: {str(e)}")
+                logger.debug("Exception details: %s", e)
+
+    def update_generate_button_state(self):
+        """Update generate button state based on current conditions"""
+        should_enable = False
+        
+        if self.is_batch_mode:
+            # Enable if we have files selected for batch mode
+            should_enable = len(self.selected_files) > 0
+        else:
+            # Enable if we have a single image selected
+            should_enable = self.current_image_path is not None
+
+        # Add custom prompt validation
+        if should_enable and self.style_combo.currentText() == "Custom":
+            should_enable = bool(self.custom_prompt_input.text().strip())
+
         self.generate_button.setEnabled(should_enable)
\ No newline at end of file
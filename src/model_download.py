@@ -42,7 +42,7 @@ class ModelDownloadDialog(QDialog):
         def download_task(api_url=None, api_key=None, repo_id=None):
             """Send download request to server"""
             # Use the correct endpoint
-            request_url = f"{api_url.rstrip('/')}/v1/download"  # Changed from /v1/model/download
+            request_url = f"{api_url}/v1/download"  # Changed from /v1/model/download
             print(f"Sending request to: {request_url}")
             
             headers = {
@@ -74,7 +74,7 @@ class ModelDownloadDialog(QDialog):
         # Create worker thread with kwargs
         self.worker = WorkerThread(
             task_func=download_task,
-            api_url=self.parent().api_url,
+            api_url=self.parent().api_base,
             api_key=self.parent().api_key,
             repo_id=repo_id
         )